@@ -0,0 +1,55 @@
+import math
+import os
+import tempfile
+
+# Uploads over MAX_UPLOAD_MB are refused outright; new work is turned away
+# with 429 while MAX_QUEUE jobs are already waiting for a worker or the
+# work dirs hold more than MAX_WORK_MB.
+MAX_UPLOAD_MB = int(os.environ.get("PDF_MAX_UPLOAD_MB", "100"))
+MAX_QUEUE = int(os.environ.get("PDF_MAX_QUEUE", "16"))
+MAX_WORK_MB = int(os.environ.get("PDF_MAX_WORK_MB", "2048"))
+WORK_ROOT = os.environ.get("PDF_WORK_DIR",
+                           os.path.join(tempfile.gettempdir(), "pdf-under-limit-work"))
+MAX_RETRY_AFTER_S = 300
+
+def work_dir():
+    """A fresh directory under WORK_ROOT, where it counts toward MAX_WORK_MB."""
+    os.makedirs(WORK_ROOT, exist_ok=True)
+    return tempfile.mkdtemp(dir=WORK_ROOT)
+
+def work_file(suffix=""):
+    os.makedirs(WORK_ROOT, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=WORK_ROOT)
+    os.close(fd)
+    return path
+
+def disk_usage(root=WORK_ROOT):
+    total = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def retry_after(jobs):
+    """Seconds until the queue has likely drained enough to take new work."""
+    queued, _ = jobs.load()
+    seconds = (queued + 1) * jobs.avg_seconds / jobs.workers
+    return max(1, min(MAX_RETRY_AFTER_S, math.ceil(seconds)))
+
+def check(jobs, content_length=None):
+    """
+    Return None to admit a request, or (status_code, reason, retry_after)
+    to turn it away. content_length is the request's Content-Length header
+    when it has one, so the body never has to be read to reject it.
+    """
+    if content_length is not None and content_length > MAX_UPLOAD_MB * 1024 * 1024:
+        return 413, f"Upload larger than {MAX_UPLOAD_MB} MB", None
+    queued, _ = jobs.load()
+    if queued >= MAX_QUEUE:
+        return 429, "Server busy, try again shortly", retry_after(jobs)
+    if disk_usage() + (content_length or 0) > MAX_WORK_MB * 1024 * 1024:
+        return 429, "Server busy, try again shortly", retry_after(jobs)
+    return None
@@ -1,16 +1,78 @@
-from fastapi import FastAPI, File, UploadFile, Form, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, FileResponse, Response
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
-import tempfile, shutil, os, subprocess, uuid, math, io
+import shutil, os, subprocess, uuid, math, io, hashlib, asyncio, json, time
+import compress_safe, gs_pool, admission, ghostscript, metrics
+from jobs import JobManager, RemoteJob, SingleFlight
+from result_cache import ResultCache, cache, file_digest
+from result_store import start_sweeper, store as results
+from upload import UploadError, receive_upload
+from timing import Timing, request_id
+from delivery import StaticPage, etag_of, file_etag, send_bytes, send_file, send_static
 
 app = FastAPI()
 
+# PDF compressions run as jobs on their own worker threads so they never hold
+# Starlette's threadpool (which serves the cheap routes); at most PDF_MAX_JOBS
+# run at once and the rest queue without taking a thread.
+MAX_JOBS = int(os.environ.get("PDF_MAX_JOBS", os.cpu_count() or 1))
+jobs = JobManager(MAX_JOBS)
+# How often a waiting /compress-pdf request checks whether its client left
+DISCONNECT_POLL_S = 0.5
+# Concurrent identical image requests share one compression
+image_flight = SingleFlight()
+
+# Routes that take an upload; admission control runs before their body is read
+UPLOAD_ROUTES = {"/compress-pdf", "/jobs/compress-pdf", "/compress-image"}
+
+class AdmissionMiddleware:
+    """
+    Plain ASGI rather than @app.middleware("http"), which would hide client
+    disconnects from the routes (see wait_for_job).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" \
+                and scope["path"] in UPLOAD_ROUTES:
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            # check() walks the work dirs, so keep it off the event loop
+            verdict = await run_in_threadpool(admission.check, jobs,
+                                              int(length) if length.isdigit() else None)
+            if verdict:
+                status, reason, retry = verdict
+                response = HTMLResponse(reason, status_code=status,
+                                        headers={"Retry-After": str(retry)} if retry else None)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(AdmissionMiddleware)
+
+@app.on_event("startup")
+def start_gs_pool():
+    # Pre-start the Ghostscript workers so the first upload skips gs start-up
+    gs_pool.get_pool(compress_safe.QUALITY_LEVELS)
+    start_sweeper(results, admission.WORK_ROOT)
+    metrics.registry.start()
+
+@app.on_event("shutdown")
+def stop_gs_pool():
+    gs_pool.close_pool()
+
 # ---------------------------
 # COMMON STYLES & PAGE RENDER
 # ---------------------------
-def render_page(title, mr_h, en_h, mr_p, en_p, default_kb, request, action, accept):
-    path = request.url.path
+def render_page(title, mr_h, en_h, mr_p, en_p, default_kb, path, action, accept,
+                job_action=None):
+    # Rendered once per path at import; the routes serve the stored bytes
     def active(p): return "active" if path == p else ""
+    # With a job endpoint the form is submitted by fetch() and polled
+    onsubmit = "return submitJob(event)" if job_action else "load()"
 
     return f"""
 <!DOCTYPE html>
@@ -76,7 +138,7 @@ button {{
   <p class="en">{en_p}</p>
 
   <form id="f" action="{action}" method="post"
-    enctype="multipart/form-data" onsubmit="load()">
+    enctype="multipart/form-data" onsubmit="{onsubmit}" data-jobs="{job_action or ''}">
     <input type="file" name="file" accept="{accept}" required>
     <input type="number" name="target_kb" value="{default_kb}" required>
     <button>
@@ -89,6 +151,11 @@ button {{
     <div class="spinner"></div>
     <div class="mr">प्रक्रिया सुरू आहे…</div>
     <div class="en">Processing…</div>
+    <div class="en" id="p"></div>
+    <button id="s" style="display:none" onclick="stopJob()">
+      <div class="mr">थांबवा</div>
+      <div class="en">Stop and use best so far</div>
+    </button>
   </div>
 </div>
 
@@ -97,6 +164,51 @@ function load() {{
   document.getElementById('f').style.display='none';
   document.getElementById('l').style.display='block';
 }}
+function fail(msg) {{
+  const d = document.createElement('div');
+  d.className = 'en';
+  d.textContent = msg;
+  document.getElementById('l').replaceChildren(d);
+}}
+async function submitJob(e) {{
+  e.preventDefault();
+  const f = document.getElementById('f');
+  load();
+  const r = await fetch(f.dataset.jobs, {{method: 'POST', body: new FormData(f)}});
+  if (!r.ok) {{ fail(await r.text()); return false; }}
+  follow((await r.json()).id);
+  return false;
+}}
+let jobId = null;
+function follow(id) {{
+  jobId = id;
+  const p = document.getElementById('p');
+  const tried = [];
+  const es = new EventSource('/jobs/' + id + '/events');
+  es.addEventListener('start', e => {{
+    p.textContent = tried.concat('Trying ' + JSON.parse(e.data).quality + '…').join(' · ');
+  }});
+  es.addEventListener('finish', e => {{
+    const a = JSON.parse(e.data);
+    tried.push(a.quality + ': ' + a.size_kb + ' KB (' + a.seconds + 's)');
+    p.textContent = tried.join(' · ');
+    document.getElementById('s').style.display = 'block';
+  }});
+  es.onerror = () => {{
+    // The browser retries dropped connections itself; CLOSED means it gave up
+    if (es.readyState === EventSource.CLOSED) fail('Lost track of the job, please try again');
+  }};
+  es.addEventListener('end', e => {{
+    es.close();
+    const state = JSON.parse(e.data).state;
+    if (state === 'done') location.href = '/jobs/' + id + '/page';
+    else fail(state === 'cancelled' ? 'Stopped' : 'Compression failed');
+  }});
+}}
+function stopJob() {{
+  document.getElementById('s').style.display = 'none';
+  fetch('/jobs/' + jobId + '/stop', {{method: 'POST'}});
+}}
 </script>
 
 </body></html>
@@ -142,106 +254,505 @@ width:100%;max-width:380px;text-align:center;">
 # ---------------------------
 # PDF
 # ---------------------------
+PDF_PAGE = StaticPage(render_page(
+    "Compress PDF",
+    "PDF Compress करा",
+    "Compress PDF",
+    "PDF आवश्यक आकारात कमी करा",
+    "Reduce PDF size",
+    500,
+    "/",
+    "/compress-pdf",
+    "application/pdf",
+    job_action="/jobs/compress-pdf"
+), "text/html; charset=utf-8")
+
 @app.get("/", response_class=HTMLResponse)
 def pdf_home(request: Request):
-    return render_page(
-        "Compress PDF",
-        "PDF Compress करा",
-        "Compress PDF",
-        "PDF आवश्यक आकारात कमी करा",
-        "Reduce PDF size",
-        500,
-        request,
-        "/compress-pdf",
-        "application/pdf"
-    )
-
-@app.post("/compress-pdf", response_class=HTMLResponse)
-def compress_pdf(bg: BackgroundTasks,
-                 file: UploadFile = File(...),
-                 target_kb: int = Form(...)):
-
-    work = tempfile.mkdtemp()
-    inp = os.path.join(work, file.filename)
-    with open(inp, "wb") as f: shutil.copyfileobj(file.file, f)
-
-    orig = math.ceil(os.path.getsize(inp)/1024)
-    if target_kb < 50:
-        shutil.rmtree(work)
-        return HTMLResponse("Minimum 50 KB", status_code=400)
-
-    fd, out = tempfile.mkstemp(suffix=".pdf")
-    os.close(fd)
-    subprocess.run(["python3","compress_safe.py",inp,out,str(target_kb)])
+    return send_static(request, PDF_PAGE)
+
+def pdf_mode(engine):
+    return f"{engine or compress_safe.ENGINE}/{compress_safe.MODE}"
+
+def compress_pdf_file(inp, out, target_kb, engine, attempts=None, progress=None, stop=None,
+                      deadline_s=None, digest=None, analysis=None):
+    """Blocking part of a PDF job; returns (cache_hit, status)."""
+    mode = pdf_mode(engine)
+    if digest is None:
+        digest = file_digest(inp)
+    key = cache and cache.key(digest, "pdf", target_kb, mode)
+    hit = cache and cache.get(key)
+    if hit:
+        try:
+            shutil.copyfile(hit[0], out)
+            return True, hit[1].get("status")
+        except OSError:
+            # Evicted between the lookup and the copy
+            pass
+
+    result = compress_safe.compress_to_target(inp, out, target_kb, engine=engine,
+                                              digest=digest, attempts=attempts,
+                                              progress=progress, stop=stop,
+                                              deadline_s=deadline_s, analysis=analysis)
+    # A stopped run is only the best so far, not the answer for this target
+    if cache and result["status"] != "stopped":
+        cache.put(key, src=out, meta={"status": result["status"]})
+    return False, result["status"]
+
+def compress_pdf_data(data, target_kb, attempts=None, progress=None, stop=None,
+                      deadline_s=None, digest=None, analysis=None):
+    """
+    In-memory compress_pdf_file() for uploads compress_safe.pipeable()
+    accepts; returns (cache_hit, status, output_bytes).
+    """
+    key = cache and cache.key(digest, "pdf", target_kb, pdf_mode(None))
+    hit = cache and cache.get_bytes(key)
+    if hit:
+        return True, hit[1].get("status"), hit[0]
+
+    out, result = compress_safe.compress_bytes(data, target_kb, digest=digest,
+                                               attempts=attempts, progress=progress,
+                                               stop=stop, deadline_s=deadline_s,
+                                               analysis=analysis)
+    if cache and result["status"] != "stopped":
+        cache.put(key, data=out, meta={"status": result["status"]})
+    return False, result["status"], out
+
+def job_budget(job, deadline_s):
+    if deadline_s is None:
+        deadline_s = compress_safe.DEADLINE_S
+    if deadline_s:
+        # The budget covers the time spent queued too
+        deadline_s = max(deadline_s - (time.time() - job.created), 0.001)
+    return deadline_s
+
+def pdf_result(orig, comp, status, hit):
+    return {"orig_kb": orig, "size_kb": comp, "pct": round((1-comp/orig)*100,1),
+            "status": status, "target_met": status in ("already_under", "success"),
+            "cache": "HIT" if hit else "MISS"}
+
+def job_timings(job, move_s):
+    """Stages only the job knows about, in seconds, for the request's Server-Timing."""
+    return {"queue": round(job.started - job.created, 4), "move": round(move_s, 4)}
+
+def record_attempts(job, orig):
+    """gs run metrics for a job, whether it finished or not."""
+    for attempt in job.attempts:
+        quality = attempt["quality"]
+        # Page-sample estimates are not full runs
+        if attempt.get("reused") or attempt.get("estimate"):
+            continue
+        if quality not in compress_safe.QUALITY_LEVELS:
+            quality = "search"
+        metrics.observe("pdf_gs_seconds", attempt["seconds"], quality=quality)
+        metrics.observe("pdf_gs_output_ratio", attempt["size_kb"] / max(orig, 1), quality=quality)
+
+def record_outcome(kind, cache_status, target_met):
+    metrics.inc("cache_requests_total", kind=kind, result=cache_status.lower())
+    metrics.inc("target_results_total", kind=kind, met=str(target_met).lower())
+
+def run_pdf_job_in_memory(job, data, orig, target_kb, deadline_s=None, digest=None,
+                          analysis=None):
+    metrics.observe("pdf_queue_wait_seconds", job.started - job.created)
+    if job.stop.is_set():
+        raise ghostscript.Cancelled()
+    try:
+        hit, status, out = compress_pdf_data(data, target_kb, job.attempts, job.emit,
+                                             job.stop, job_budget(job, deadline_s), digest,
+                                             analysis)
+    finally:
+        record_attempts(job, orig)
+    if job.cancelled:
+        raise ghostscript.Cancelled()
+    started = time.monotonic()
+    token = results.put_bytes(out, "compressed.pdf")
+    result = pdf_result(orig, math.ceil(len(out)/1024), status, hit)
+    record_outcome("pdf", result["cache"], result["target_met"])
+    return dict(result, token=token, timings=job_timings(job, time.monotonic() - started))
+
+def run_pdf_job(job, work, inp, orig, target_kb, engine, deadline_s=None, digest=None,
+                analysis=None):
+    metrics.observe("pdf_queue_wait_seconds", job.started - job.created)
+    if job.stop.is_set():
+        # Stopped or cancelled while queued
+        shutil.rmtree(work, ignore_errors=True)
+        raise ghostscript.Cancelled()
+
+    deadline_s = job_budget(job, deadline_s)
+    out = admission.work_file(suffix=".pdf")
+    try:
+        hit, status = compress_pdf_file(inp, out, target_kb, engine, job.attempts,
+                                        job.emit, job.stop, deadline_s, digest, analysis)
+        if job.cancelled:
+            raise ghostscript.Cancelled()
+    except BaseException:
+        os.remove(out)
+        raise
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        record_attempts(job, orig)
 
     comp = math.ceil(os.path.getsize(out)/1024)
-    pct = round((1-comp/orig)*100,1)
-    bg.add_task(shutil.rmtree, work)
+    started = time.monotonic()
+    token = results.put_file(out, "compressed.pdf")
+    result = pdf_result(orig, comp, status, hit)
+    record_outcome("pdf", result["cache"], result["target_met"])
+    return dict(result, token=token, timings=job_timings(job, time.monotonic() - started))
+
+def form_number(fields, name, kind, required=False):
+    value = fields.get(name, "").strip()
+    if not value:
+        if required:
+            raise UploadError(400, f"Missing {name}")
+        return None
+    try:
+        return kind(value)
+    except ValueError:
+        raise UploadError(400, f"Invalid {name}")
+
+async def submit_pdf_job(request, timing):
+    """
+    Stream the upload into a work dir and queue it; returns the job or an
+    error response. The digest comes out of the upload, so a result that is
+    already cached queues at zero cost and runs next. Uploads small enough
+    for compress_safe.pipeable() are compressed in memory; only the final
+    output is written, to the result store.
+    """
+    length = request.headers.get("content-length", "")
+    in_memory = length.isdigit() and compress_safe.pipeable(int(length))
+    work = None if in_memory else admission.work_dir()
+    inp = None if in_memory else os.path.join(work, "input.pdf")
+    try:
+        started = time.monotonic()
+        upload = await receive_upload(request, inp, admission.MAX_UPLOAD_MB * 1024 * 1024,
+                                      magic=b"%PDF-")
+        metrics.observe("pdf_upload_seconds", time.monotonic() - started)
+        timing.add("upload", time.monotonic() - started)
+        target_kb = form_number(upload.fields, "target_kb", int, required=True)
+        deadline_s = form_number(upload.fields, "deadline_s", float)
+        engine = upload.fields.get("engine") or None
+        if target_kb < 50:
+            raise UploadError(400, "Minimum 50 KB")
+        if engine is not None and engine not in compress_safe.ENGINES:
+            raise UploadError(400, "Unknown engine")
+        if deadline_s is not None and deadline_s <= 0:
+            raise UploadError(400, "Deadline must be positive")
+    except UploadError as e:
+        if work:
+            shutil.rmtree(work, ignore_errors=True)
+        # Plain text: the message can carry client-supplied input
+        return PlainTextResponse(str(e), status_code=e.status_code)
+    except BaseException:
+        if work:
+            shutil.rmtree(work, ignore_errors=True)
+        raise
+
+    data = upload.data
+    if data is not None and not compress_safe.pipeable(len(data), engine):
+        # Another engine was asked for; those need a file
+        work = admission.work_dir()
+        inp = os.path.join(work, "input.pdf")
+        with open(inp, "wb") as f:
+            f.write(data)
+        data = None
+
+    orig = math.ceil(upload.size/1024)
+    digest = upload.digest
+    cached = cache and os.path.exists(cache.paths(cache.key(digest, "pdf", target_kb,
+                                                            pdf_mode(engine)))[0])
+    started = time.monotonic()
+    # The job reuses the cost estimate's analysis instead of parsing again
+    cost, analysis = (0.0, None) if cached else \
+        await run_in_threadpool(compress_safe.estimate_cost, inp, data)
+    if not cached:
+        timing.add("analysis", time.monotonic() - started, "cost estimate")
+    # Identical uploads in flight at the same time share one job
+    key = ResultCache.key(digest, "pdf", target_kb, f"{pdf_mode(engine)}/{deadline_s}")
+    if data is not None:
+        job, joined = jobs.share(key, run_pdf_job_in_memory, data, orig, target_kb, deadline_s,
+                                 digest, analysis, cost=cost)
+    else:
+        job, joined = jobs.share(key, run_pdf_job, work, inp, orig, target_kb, engine,
+                                 deadline_s, digest, analysis, cost=cost)
+        if joined:
+            shutil.rmtree(work, ignore_errors=True)
+    if joined:
+        metrics.inc("cache_requests_total", kind="pdf", result="shared")
+    return job
+
+async def wait_for_job(request, job):
+    """
+    Await the job's result, cancelling it if the client disconnects first so
+    its gs processes are killed and its files removed.
+    """
+    future = asyncio.wrap_future(job.future)
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_S)
+        if done:
+            return future.result()
+        if await request.is_disconnected():
+            break
 
-    return result_page(orig, comp, pct, f"/download-pdf?f={out}")
+    if job.cancel():
+        await asyncio.wait({future})
+        if future.exception() is None:
+            # Finished before it saw the cancel
+            results.remove(future.result()["token"])
+    # else other requests still wait on the shared job
+    raise ghostscript.Cancelled()
 
-@app.get("/download-pdf")
-def dl_pdf(f: str, bg: BackgroundTasks):
-    bg.add_task(os.remove, f)
-    return FileResponse(f, filename="compressed.pdf")
+@app.post("/compress-pdf", response_class=HTMLResponse)
+async def compress_pdf(request: Request):
+    # Form fields: file, target_kb, and optionally engine and deadline_s
+    timing = Timing(request_id(request.headers.get("x-request-id")))
+    job = await submit_pdf_job(request, timing)
+    if isinstance(job, Response):
+        timing.log("compress_pdf", status_code=job.status_code)
+        job.headers.update(timing.headers())
+        return job
+    try:
+        r = await wait_for_job(request, job)
+    except subprocess.CalledProcessError:
+        timing.log("compress_pdf", status_code=500, job=job.id)
+        return HTMLResponse("Compression failed", status_code=500, headers=timing.headers())
+    except ghostscript.Cancelled:
+        # Client went away; nobody reads this
+        timing.log("compress_pdf", status_code=499, job=job.id)
+        return Response(status_code=499)
+
+    timing.add("queue", r["timings"]["queue"])
+    timing.add_events(job.events)
+    timing.add_attempts(job.attempts)
+    timing.add("move", r["timings"]["move"])
+    with timing.stage("render"):
+        page = result_page(r["orig_kb"], r["size_kb"], r["pct"], f"/results/{r['token']}")
+    timing.log("compress_pdf", status_code=200, job=job.id, orig_kb=r["orig_kb"],
+               size_kb=r["size_kb"], cache=r["cache"], target_met=r["target_met"])
+    return HTMLResponse(page, headers={"X-Cache": r["cache"],
+                                       "X-Target-Met": "1" if r["target_met"] else "0",
+                                       **timing.headers()})
+
+@app.post("/jobs/compress-pdf")
+async def submit_compress_pdf(request: Request):
+    timing = Timing(request_id(request.headers.get("x-request-id")))
+    job = await submit_pdf_job(request, timing)
+    if isinstance(job, Response):
+        timing.log("submit_pdf_job", status_code=job.status_code)
+        job.headers.update(timing.headers())
+        return job
+    # The gs attempts are timed in the job's attempts list
+    # Identical uploads share the job, but each submitter gets its own
+    # ticket so one of them cannot stop it for the others
+    ticket = await run_in_threadpool(job.add_ticket)
+    timing.log("submit_pdf_job", status_code=202, job=job.id)
+    return JSONResponse({"id": ticket, "status_url": f"/jobs/{ticket}"}, status_code=202,
+                        headers=timing.headers())
+
+def job_or_404(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return None, JSONResponse({"error": "unknown job"}, status_code=404)
+    return job, None
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job, missing = job_or_404(job_id)
+    if missing:
+        return missing
+    d = dict(job.to_dict(), id=job_id)
+    if d["result"]:
+        d["result_url"] = f"/results/{d['result']['token']}"
+    return d
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: one per attempt start/finish, then "end"."""
+    job, missing = job_or_404(job_id)
+    if missing:
+        return missing
+
+    async def stream():
+        nonlocal job
+        sent = 0
+        while True:
+            if isinstance(job, RemoteJob):
+                # Run by another worker process; reread its file
+                job = jobs.get(job_id) or job
+            # Read finished first so no event appended before it is missed
+            finished = job.finished is not None
+            events = job.events[sent:]
+            for e in events:
+                yield f"event: {e['event']}\ndata: {json.dumps(e)}\n\n"
+            sent += len(events)
+            if finished:
+                yield f"event: end\ndata: {json.dumps({'state': job.state})}\n\n"
+                return
+            await asyncio.sleep(0.2)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/jobs/{job_id}/stop")
+def job_stop(job_id: str):
+    """
+    Finish early with the best output so far (or cancel a queued job). A job
+    shared by identical uploads stops once all of its submitters ask.
+    """
+    job, missing = job_or_404(job_id)
+    if missing:
+        return missing
+    jobs.stop(job_id)
+    return JSONResponse({"id": job_id, "state": job.state}, status_code=202)
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str, request: Request):
+    job, missing = job_or_404(job_id)
+    if missing:
+        return missing
+    if job.state != "done":
+        return JSONResponse({"error": "result not available", "state": job.state},
+                            status_code=409)
+    return download(job.result["token"], request)
+
+@app.get("/jobs/{job_id}/page", response_class=HTMLResponse)
+def job_page(job_id: str):
+    job, missing = job_or_404(job_id)
+    if missing:
+        return missing
+    if job.state != "done":
+        return HTMLResponse("Compression failed" if job.state == "failed" else "Not ready",
+                            status_code=500 if job.state == "failed" else 409)
+    r = job.result
+    return result_page(r["orig_kb"], r["size_kb"], r["pct"], f"/results/{r['token']}")
+
+@app.get("/results/{token}")
+def download(token: str, request: Request):
+    """
+    A stored result; downloadable any number of times until it expires, with
+    Range for resumed downloads and If-None-Match for repeat ones.
+    """
+    entry = results.get(token)
+    if entry is None:
+        return JSONResponse({"error": "result expired or unknown"}, status_code=410)
+    body, meta = entry
+    headers = {"Cache-Control": "private, no-transform"}
+    # Results stored before ETags were recorded get one on the fly
+    etag = meta.get("etag") or file_etag(body)
+    return send_file(request, body, etag, meta["filename"], meta["media_type"], headers)
 
 # ---------------------------
 # IMAGE
 # ---------------------------
+IMAGE_PAGE = StaticPage(render_page(
+    "Compress Image",
+    "प्रतिमा Compress करा",
+    "Compress Image",
+    "JPG किंवा PNG फोटोचा आकार कमी करा",
+    "Reduce JPG / PNG size",
+    100,
+    "/image",
+    "/compress-image",
+    "image/jpeg,image/png"
+), "text/html; charset=utf-8")
+
 @app.get("/image", response_class=HTMLResponse)
 def img_home(request: Request):
-    return render_page(
-        "Compress Image",
-        "प्रतिमा Compress करा",
-        "Compress Image",
-        "JPG किंवा PNG फोटोचा आकार कमी करा",
-        "Reduce JPG / PNG size",
-        100,
-        request,
-        "/compress-image",
-        "image/jpeg,image/png"
-    )
+    return send_static(request, IMAGE_PAGE)
 
 @app.post("/compress-image", response_class=HTMLResponse)
-def compress_image(file: UploadFile = File(...),
+def compress_image(request: Request,
+                   file: UploadFile = File(...),
                    target_kb: int = Form(...)):
-
-    img = Image.open(file.file).convert("RGB")
+    timing = Timing(request_id(request.headers.get("x-request-id")))
+    with timing.stage("upload"):
+        data = file.file.read()
+        key = ResultCache.key(hashlib.sha256(data).hexdigest(), "image", target_kb, "jpeg")
+    with timing.stage("cache"):
+        hit = cache and cache.get_bytes(key)
+    if hit:
+        record_outcome("image", "HIT", True)
+        return image_reply(request, timing, hit[0], "HIT")
+
+    with timing.stage("encode"):
+        out, shared = image_flight.do(key, compress_image_bytes, data, target_kb, key)
+    status = "SHARED" if shared else "MISS"
+    record_outcome("image", status, out is not None)
+    if out is None:
+        timing.log("compress_image", status_code=200, cache=status, target_met=False)
+        return HTMLResponse("Cannot compress without quality loss", headers=timing.headers())
+    return image_reply(request, timing, out, status)
+
+def image_reply(request, timing, data, cache_status):
+    with timing.stage("render"):
+        response = jpeg_response(request, data, cache_status)
+    timing.log("compress_image", status_code=response.status_code, size_kb=len(data) // 1024,
+               cache=cache_status, target_met=True)
+    response.headers.update(timing.headers())
+    return response
+
+def compress_image_bytes(data, target_kb, key):
+    """JPEG under target_kb, or None if quality would drop below 20."""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
     buf = io.BytesIO()
     quality = 90
+    encodes = 0
 
     while quality >= 20:
         buf.seek(0); buf.truncate()
         img.save(buf, format="JPEG", quality=quality)
+        encodes += 1
         if len(buf.getvalue())/1024 <= target_kb:
             break
         quality -= 5
 
+    metrics.observe("image_encode_iterations", encodes)
     if len(buf.getvalue())/1024 > target_kb:
-        return HTMLResponse("Cannot compress without quality loss")
+        return None
+
+    if cache:
+        cache.put(key, data=buf.getvalue(), meta={"quality": quality})
+    return buf.getvalue()
+
+def jpeg_response(request, data, cache_status):
+    fname = f"img_{math.ceil(len(data)/1024)}kb.jpg"
+    return send_bytes(request, data, etag_of(data), fname, "image/jpeg",
+                      {"X-Cache": cache_status})
+
+@app.get("/queue-stats")
+def queue_stats():
+    queued, running = jobs.load()
+    return {"queued": queued, "running": running, "classes": jobs.queue_stats()}
 
-    fname = f"img_{math.ceil(len(buf.getvalue())/1024)}kb.jpg"
-    return FileResponse(io.BytesIO(buf.getvalue()),
-                        filename=fname,
-                        media_type="image/jpeg")
+@app.get("/metrics")
+def metrics_page():
+    gauges = {"work_disk_bytes": admission.disk_usage(),
+              "results_disk_bytes": admission.disk_usage(results.root)}
+    return Response(metrics.registry.render(gauges),
+                    media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache-stats")
+def cache_stats():
+    return cache.stats() if cache else {"enabled": False}
 
 # ---------------------------
 # SEO FILES
 # ---------------------------
-@app.get("/sitemap.xml", response_class=Response)
-def sitemap():
-    return Response(
-        content="""<?xml version="1.0"?>
+SEO_CACHE_CONTROL = "public, max-age=86400"
+
+SITEMAP = StaticPage("""<?xml version="1.0"?>
 <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
 <url><loc>https://pdf-under-limit.onrender.com/</loc></url>
 <url><loc>https://pdf-under-limit.onrender.com/image</loc></url>
-</urlset>""",
-        media_type="application/xml"
-    )
+</urlset>""", "application/xml", SEO_CACHE_CONTROL)
+
+ROBOTS = StaticPage(
+    "User-agent: *\nAllow: /\nSitemap: https://pdf-under-limit.onrender.com/sitemap.xml",
+    "text/plain", SEO_CACHE_CONTROL)
+
+@app.get("/sitemap.xml", response_class=Response)
+def sitemap(request: Request):
+    return send_static(request, SITEMAP)
 
 @app.get("/robots.txt", response_class=Response)
-def robots():
-    return Response(
-        content="User-agent: *\nAllow: /\nSitemap: https://pdf-under-limit.onrender.com/sitemap.xml",
-        media_type="text/plain"
-    )
+def robots(request: Request):
+    return send_static(request, ROBOTS)
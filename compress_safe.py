@@ -1,27 +1,696 @@
-import subprocess
 import sys
 import os
 import shutil
-import tempfile
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import admission
+import ghostscript
+import gs_pool
+import pdf_analyze
+import pdf_images
+import pdf_shard
+import result_cache
+from timing import Timing, request_id
 
 QUALITY_LEVELS = ["ebook", "screen"]
 
+# Start every QUALITY_LEVELS attempt at once instead of one after another.
+# Costs one core per level for lower worst-case latency.
+SPECULATIVE = os.environ.get("PDF_SPECULATIVE", "0") == "1"
+
+# Backend for each ladder attempt: "gs" is a single pdfwrite pass, "sharded"
+# splits the pages across cores and merges the results (see pdf_shard), and
+# "images" only recompresses image XObjects with Pillow (see pdf_images).
+ENGINE = os.environ.get("PDF_ENGINE", "gs")
+
+# "ladder" walks QUALITY_LEVELS; "search" bisects over explicit image settings.
+MODE = os.environ.get("PDF_MODE", "ladder")
+
+# Search mode maps a knob t in [0, 1] onto image resolution and JPEG QFactor
+# (lower QFactor is higher quality) and stops within SEARCH_TOLERANCE of the
+# target, after SEARCH_MAX_ITERATIONS gs runs, or once SEARCH_DEADLINE_S passes.
+SEARCH_MIN_DPI = 36
+SEARCH_MAX_DPI = 200
+SEARCH_MIN_QFACTOR = 0.4
+SEARCH_MAX_QFACTOR = 1.3
+SEARCH_TOLERANCE = 0.95
+SEARCH_MAX_ITERATIONS = int(os.environ.get("PDF_SEARCH_MAX_ITERATIONS", "6"))
+SEARCH_DEADLINE_S = float(os.environ.get("PDF_SEARCH_DEADLINE_S", "0")) or None
+
+# Scan the PDF before the first gs run to choose where to start the ladder.
+# Predictions are rough, so a level is only skipped when it is predicted to
+# miss by SKIP_MARGIN, and the ladder goes straight to best effort only when
+# even the last level is predicted to miss by OUT_OF_REACH_MARGIN. Only the
+# image part of a prediction is modelled; what pdfwrite does to fonts and
+# content streams is a guess, so files whose image share is below
+# ANALYZE_MIN_IMAGE_SHARE always walk the full ladder.
+ANALYZE = os.environ.get("PDF_ANALYZE", "1") == "1"
+SKIP_MARGIN = 1.3
+OUT_OF_REACH_MARGIN = 2.0
+ANALYZE_MIN_IMAGE_SHARE = 0.5
+
+# Documents with at least SAMPLE_MIN_PAGES pages compress SAMPLE_PAGES pages
+# spread through the file at each level, extrapolate the full size and run
+# the full pass only at the level the estimate picks. If that pass lands
+# under SAMPLE_RETRY_BELOW of the target, the level above it is tried too.
+SAMPLE_MIN_PAGES = int(os.environ.get("PDF_SAMPLE_MIN_PAGES", "100"))
+SAMPLE_PAGES = int(os.environ.get("PDF_SAMPLE_PAGES", "5"))
+SAMPLE_RETRY_BELOW = 0.5
+
+# Latency budget per call (0 = none). Once it runs out, the call returns
+# the best output so far as soon as there is one, killing running attempts.
+DEADLINE_S = float(os.environ.get("PDF_DEADLINE_S", "0")) or None
+
+# Inputs up to PIPE_MAX_MB may be compressed in memory (see compress_bytes):
+# gs reads stdin and writes stdout, so no temp files are involved.
+PIPE_MAX_MB = int(os.environ.get("PDF_PIPE_MAX_MB", "10"))
+
+# Rough gs seconds per input MB (more for image bytes, which get resampled
+# and re-encoded) and per page, used to order queued jobs
+COST_PER_MB = 0.1
+COST_PER_IMAGE_MB = 0.4
+COST_PER_PAGE = 0.02
+
 def get_size_kb(file_path):
     return os.path.getsize(file_path) // 1024
 
-def compress_pdf(input_pdf, output_pdf, quality):
+def compress_pdf(input_pdf, output_pdf, quality, cancel=None, pages=None):
+    pool = gs_pool.get_pool(QUALITY_LEVELS)
+    if pool is not None and pages is None and quality in pool.idle \
+            and pool.accepts(input_pdf, output_pdf):
+        pool.compress(input_pdf, output_pdf, quality, cancel)
+        return
+
+    extra = [] if pages is None else ["-sPageList=" + ",".join(str(p) for p in pages)]
+    ghostscript.run(ghostscript.pdfwrite_args([input_pdf], output_pdf, quality, extra), cancel)
+
+def compress_pdf_bytes(data, quality, cancel=None):
+    return ghostscript.run_pipe(ghostscript.pdfwrite_args(["-"], "%stdout", quality),
+                                data, cancel)
+
+def compress_pdf_tuned(input_pdf, output_pdf, dpi, qfactor, cancel=None):
+    # pdfwrite has no -dJPEGQ; JPEG quality goes through the image dicts
+    image_dict = (f"<< /QFactor {qfactor} /Blend 1 "
+                  "/HSamples [2 1 1 2] /VSamples [2 1 1 2] >>")
     command = [
-        "gs",
         "-sDEVICE=pdfwrite",
         "-dCompatibilityLevel=1.4",
-        f"-dPDFSETTINGS=/{quality}",
         "-dNOPAUSE",
         "-dQUIET",
         "-dBATCH",
+        "-dPassThroughJPEGImages=false",
+        "-dDownsampleColorImages=true",
+        "-dDownsampleGrayImages=true",
+        "-dDownsampleMonoImages=true",
+        "-dColorImageDownsampleType=/Bicubic",
+        "-dGrayImageDownsampleType=/Bicubic",
+        "-dColorImageDownsampleThreshold=1.0",
+        "-dGrayImageDownsampleThreshold=1.0",
+        f"-dColorImageResolution={dpi}",
+        f"-dGrayImageResolution={dpi}",
+        f"-dMonoImageResolution={max(dpi * 2, 150)}",
+        "-dAutoFilterColorImages=false",
+        "-dAutoFilterGrayImages=false",
+        "-dColorImageFilter=/DCTEncode",
+        "-dGrayImageFilter=/DCTEncode",
         f"-sOutputFile={output_pdf}",
+        "-c",
+        f"<< /ColorImageDict {image_dict} /GrayImageDict {image_dict} >> setdistillerparams",
+        "-f",
         input_pdf
     ]
-    subprocess.run(command, check=True)
+    ghostscript.run(command, cancel)
+
+def search_settings(t):
+    dpi = round(SEARCH_MIN_DPI + t * (SEARCH_MAX_DPI - SEARCH_MIN_DPI))
+    qfactor = round(SEARCH_MAX_QFACTOR - t * (SEARCH_MAX_QFACTOR - SEARCH_MIN_QFACTOR), 2)
+    return dpi, qfactor
+
+class Control:
+    """
+    Per-call state for compress_to_target(): the target, the attempts list,
+    an optional progress callback, a stop event and a deadline. Setting stop
+    kills the running gs work and makes the call return the best output
+    produced so far. The deadline sets stop once it has passed and an output
+    exists. Without either, runs cannot be stopped.
+    """
+
+    def __init__(self, target_kb, attempts=None, progress=None, stop=None, deadline_s=None):
+        self.target_kb = target_kb
+        self.attempts = [] if attempts is None else attempts
+        self.progress = progress
+        if deadline_s and stop is None:
+            stop = threading.Event()
+        self.stop = stop
+        self.started = time.monotonic()
+        self.has_output = False
+        self.timed_out = False
+        self.timer = None
+        if deadline_s:
+            self.timer = threading.Timer(deadline_s, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        # Flag first, then check: produced() does the reverse, so one of
+        # the two always sees the other
+        self.timed_out = True
+        if self.has_output:
+            self.stop.set()
+
+    def produced(self):
+        """Record that a usable output exists; from here the deadline can stop us."""
+        self.has_output = True
+        if self.timed_out:
+            self.stop.set()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def emit(self, event, **fields):
+        if self.progress is not None:
+            self.progress({"event": event,
+                           "t": round(time.monotonic() - self.started, 3), **fields})
+
+    def stopped(self):
+        return self.stop is not None and self.stop.is_set()
+
+def outcome(status, attempt, ctl):
+    return {"status": status, "size_kb": attempt["size_kb"], "quality": attempt["quality"],
+            "target_met": attempt["size_kb"] <= ctl.target_kb, "attempts": ctl.attempts}
+
+def compress_search(input_pdf, output_pdf, target_kb, ctl,
+                    max_iterations=None, deadline_s=None):
+    """
+    Bisect over search_settings() for the highest-quality output that fits.
+    Probes t=1 and t=0 first so easy and impossible targets end early.
+    """
+    if max_iterations is None:
+        max_iterations = SEARCH_MAX_ITERATIONS
+    if deadline_s is None:
+        deadline_s = SEARCH_DEADLINE_S
+    deadline = time.monotonic() + deadline_s if deadline_s else None
+
+    tried = []
+    best = None      # attempt of the largest output that fits
+    smallest = None  # attempt of the smallest output, for the best-effort fallback
+    lo, hi = 0.0, 1.0
+    probes = [1.0, 0.0]
+    try:
+        for _ in range(max(1, max_iterations)):
+            if ctl.stopped():
+                break
+            if smallest is not None and deadline is not None and time.monotonic() >= deadline:
+                break
+            t = probes.pop(0) if probes else (lo + hi) / 2
+            dpi, qfactor = search_settings(t)
+            quality = f"search@{dpi}dpi/q{qfactor}"
+
+            path = admission.work_file(suffix=".pdf")
+            tried.append(path)
+            started = time.monotonic()
+            ctl.emit("start", quality=quality)
+            try:
+                compress_pdf_tuned(input_pdf, path, dpi, qfactor, ctl.stop)
+            except ghostscript.Cancelled:
+                break
+            attempt = {"quality": quality, "size_kb": get_size_kb(path),
+                       "seconds": round(time.monotonic() - started, 3),
+                       "dpi": dpi, "qfactor": qfactor}
+            ctl.attempts.append(attempt)
+            ctl.emit("finish", **attempt)
+            attempt = dict(attempt, path=path)
+
+            if attempt["size_kb"] <= target_kb:
+                lo = t
+                if best is None or attempt["size_kb"] > best["size_kb"]:
+                    best = attempt
+            else:
+                hi = t
+            if smallest is None or attempt["size_kb"] < smallest["size_kb"]:
+                smallest = attempt
+            ctl.produced()
+            for old in tried:
+                if old not in (best and best["path"], smallest["path"]) and os.path.exists(old):
+                    os.remove(old)
+
+            if best is not None and (t == 1.0 or best["size_kb"] >= target_kb * SEARCH_TOLERANCE):
+                break
+            if best is None and t == 0.0:
+                break
+
+        final = best or smallest
+        if final is None:
+            raise ghostscript.Cancelled()
+        shutil.move(final["path"], output_pdf)
+        status = "success" if best else "stopped" if ctl.stopped() else "best_effort"
+        return outcome(status, final, ctl)
+    finally:
+        for path in tried:
+            if os.path.exists(path):
+                os.remove(path)
+
+ENGINES = {
+    "gs": compress_pdf,
+    "sharded": pdf_shard.compress_pdf_sharded,
+    "images": pdf_images.compress_pdf_images,
+}
+
+def variant_cache(digest, quality, engine):
+    """The cache and key for one ladder step's output, or (None, None)."""
+    cache = result_cache.cache if digest else None
+    return cache, cache and cache.key(digest, "variant", quality, engine)
+
+def run_attempt(input_pdf, output_pdf, quality, ctl, cancel=None, engine="gs", digest=None):
+    """
+    Run one ladder step. With a digest of the input, every output is kept in
+    the result cache so a later request for the same document with another
+    target can reuse it instead of running gs again.
+    """
+    cache, key = variant_cache(digest, quality, engine)
+    started = time.monotonic()
+    ctl.emit("start", quality=quality)
+    attempt = None
+    hit = cache and cache.get(key, count=False)
+    if hit:
+        try:
+            shutil.copyfile(hit[0], output_pdf)
+            attempt = {"quality": quality, "size_kb": get_size_kb(output_pdf),
+                       "seconds": round(time.monotonic() - started, 3), "reused": True}
+        except OSError:
+            pass
+
+    if attempt is None:
+        ENGINES[engine](input_pdf, output_pdf, quality, cancel)
+        if cache:
+            cache.put(key, src=output_pdf, meta={"quality": quality, "engine": engine})
+        attempt = {"quality": quality, "size_kb": get_size_kb(output_pdf),
+                   "seconds": round(time.monotonic() - started, 3)}
+    ctl.emit("finish", **attempt)
+    return attempt
+
+def run_attempt_bytes(data, quality, ctl, digest=None):
+    """run_attempt() for compress_bytes(): returns (attempt, output bytes)."""
+    cache, key = variant_cache(digest, quality, "gs")
+    started = time.monotonic()
+    ctl.emit("start", quality=quality)
+    hit = cache and cache.get_bytes(key, count=False)
+    if hit:
+        out = hit[0]
+    else:
+        out = compress_pdf_bytes(data, quality, ctl.stop)
+        if cache:
+            cache.put(key, data=out, meta={"quality": quality, "engine": "gs"})
+    attempt = {"quality": quality, "size_kb": len(out) // 1024,
+               "seconds": round(time.monotonic() - started, 3)}
+    if hit:
+        attempt["reused"] = True
+    ctl.emit("finish", **attempt)
+    return attempt, out
+
+def analyze_input(input_pdf):
+    try:
+        report = pdf_analyze.analyze(input_pdf)
+    except (OSError, ValueError):
+        return None
+    return None if report["encrypted"] else report
+
+def analyze_data(data):
+    try:
+        report = pdf_analyze.analyze_bytes(data)
+    except ValueError:
+        return None
+    return None if report["encrypted"] else report
+
+def timed_analysis(ctl, analyze, source, report=None):
+    """
+    analyze(source) when PDF_ANALYZE is on, reported as an "analysis"
+    event, unless the caller already has the report.
+    """
+    if not ANALYZE:
+        return None
+    if report is not None:
+        return None if report["encrypted"] else report
+    started = time.monotonic()
+    report = analyze(source)
+    ctl.emit("analysis", seconds=round(time.monotonic() - started, 3))
+    return report
+
+def estimate_cost(input_pdf=None, data=None):
+    """
+    Relative cost of compressing a file or bytes, in approximate gs seconds,
+    and the pdf_analyze report it is based on (None if unreadable), which
+    compress_to_target() and compress_bytes() take as analysis.
+    """
+    size = len(data) if data is not None else os.path.getsize(input_pdf)
+    try:
+        report = pdf_analyze.analyze_bytes(data) if data is not None \
+            else pdf_analyze.analyze(input_pdf)
+    except (OSError, ValueError):
+        report = None
+    # Encrypted files still give a page count; unreadable ones count as all
+    # image bytes with no pages
+    image_share, pages = (1.0, 0) if report is None else (report["image_share"], report["pages"])
+    cost = (size / (1024 * 1024) * (COST_PER_MB + COST_PER_IMAGE_MB * image_share)
+            + pages * COST_PER_PAGE) * len(QUALITY_LEVELS)
+    return cost, report
+
+def plan_levels(report, target_kb):
+    """Drop the QUALITY_LEVELS that the static analysis says cannot fit."""
+    if report is None or report["image_share"] < ANALYZE_MIN_IMAGE_SHARE:
+        return QUALITY_LEVELS
+
+    predicted = {q: pdf_analyze.predict_size_kb(report, q)
+                 for q in QUALITY_LEVELS if q in pdf_analyze.QUALITY_DPI}
+    if len(predicted) != len(QUALITY_LEVELS):
+        return QUALITY_LEVELS
+
+    if predicted[QUALITY_LEVELS[-1]] > target_kb * OUT_OF_REACH_MARGIN:
+        return QUALITY_LEVELS[-1:]
+    start = 0
+    while start < len(QUALITY_LEVELS) - 1 and \
+            predicted[QUALITY_LEVELS[start]] > target_kb * SKIP_MARGIN:
+        start += 1
+    return QUALITY_LEVELS[start:]
+
+def sample_pages(page_count, n):
+    step = page_count / n
+    return sorted({int(step * k + step / 2) + 1 for k in range(n)})
+
+def estimate_by_sampling(input_pdf, page_count, levels, target_kb, ctl, engine="gs",
+                         digest=None):
+    """
+    Estimate the full-document size at each level from a page sample, in
+    order, stopping at the first level estimated to fit target_kb.
+    Per-file overhead such as fonts is in every sample once, whatever its
+    page count, so it is measured from a one-page run of the first sampled
+    page and only the per-page part is scaled up to page_count. Levels
+    already in the variant cache use the cached size instead.
+    """
+    pages = sample_pages(page_count, min(SAMPLE_PAGES, page_count))
+    estimates = {}
+    sample_output = admission.work_file(suffix=".pdf")
+    try:
+        for quality in levels:
+            cache, key = variant_cache(digest, quality, engine)
+            hit = cache and cache.get(key, count=False)
+            try:
+                estimates[quality] = get_size_kb(hit[0]) if hit else None
+            except OSError:
+                estimates[quality] = None
+            if estimates[quality] is None:
+                estimates[quality] = sample_level(input_pdf, page_count, pages, quality,
+                                                  sample_output, ctl)
+            if estimates[quality] <= target_kb:
+                break
+    finally:
+        os.remove(sample_output)
+    return estimates
+
+def sample_level(input_pdf, page_count, pages, quality, sample_output, ctl):
+    label = f"{quality} (estimate from {len(pages)} pages)"
+    started = time.monotonic()
+    ctl.emit("start", quality=label)
+    compress_pdf(input_pdf, sample_output, quality, ctl.stop, pages=pages)
+    sample = os.path.getsize(sample_output)
+    if len(pages) > 1:
+        compress_pdf(input_pdf, sample_output, quality, ctl.stop, pages=pages[:1])
+        per_page = max(0, sample - os.path.getsize(sample_output)) / (len(pages) - 1)
+        fixed = max(0, sample - per_page * len(pages))
+    else:
+        per_page, fixed = sample, 0
+    estimate = int(fixed + per_page * page_count) // 1024
+    attempt = {"quality": label, "size_kb": estimate,
+               "seconds": round(time.monotonic() - started, 3), "estimate": True}
+    ctl.attempts.append(attempt)
+    ctl.emit("finish", **attempt)
+    return estimate
+
+def try_level_above(input_pdf, output_pdf, target_kb, ctl, quality, temp_output,
+                    engine="gs", digest=None):
+    """
+    Run a level the sample estimate ruled out, after the level it picked
+    came in well under target. Returns an outcome if it fits, else None.
+    """
+    if ctl.stopped():
+        return None
+    try:
+        attempt = run_attempt(input_pdf, temp_output, quality, ctl, ctl.stop, engine, digest)
+    except ghostscript.Cancelled:
+        return None
+    ctl.attempts.append(attempt)
+    if attempt["size_kb"] > target_kb:
+        return None
+    shutil.move(temp_output, output_pdf)
+    return outcome("success", attempt, ctl)
+
+def walk_ladder(levels, target_kb, ctl, attempt_fn):
+    """
+    The ladder loop behind compress_ladder() and compress_bytes():
+    attempt_fn(quality) runs one level and returns (attempt, output).
+    Returns (status, attempt, output) for the output to keep.
+    """
+    # Every level is smaller than the one before, so the last finished
+    # attempt is the best result to fall back on
+    best = best_output = None
+    for quality in levels:
+        if ctl.stopped():
+            break
+        try:
+            attempt, output = attempt_fn(quality)
+        except ghostscript.Cancelled:
+            break
+        ctl.attempts.append(attempt)
+
+        if attempt["size_kb"] <= target_kb:
+            return "success", attempt, output
+        best, best_output = attempt, output
+        ctl.produced()
+
+    if best is None:
+        raise ghostscript.Cancelled()
+    return "stopped" if ctl.stopped() else "best_effort", best, best_output
+
+def compress_ladder(input_pdf, output_pdf, target_kb, ctl, levels, temp_output,
+                    engine="gs", digest=None):
+    best_output = admission.work_file(suffix=".pdf")
+
+    def attempt_fn(quality):
+        attempt = run_attempt(input_pdf, temp_output, quality, ctl, ctl.stop, engine, digest)
+        os.replace(temp_output, best_output)
+        return attempt, best_output
+
+    try:
+        status, attempt, output = walk_ladder(levels, target_kb, ctl, attempt_fn)
+        shutil.move(output, output_pdf)
+        return outcome(status, attempt, ctl)
+    finally:
+        if os.path.exists(best_output):
+            os.remove(best_output)
+
+def settled(results, target_kb, levels, failed=()):
+    """
+    Pick the winning level from finished attempts, or None while a
+    higher-quality attempt that might still fit is running. Levels in
+    failed are passed over.
+    """
+    for quality in levels:
+        if quality in failed:
+            continue
+        if quality not in results:
+            return None
+        if results[quality]["size_kb"] <= target_kb:
+            return quality
+    return best_so_far(results, target_kb, levels)
+
+def best_so_far(results, target_kb, levels):
+    done = [q for q in levels if q in results]
+    fits = [q for q in done if results[q]["size_kb"] <= target_kb]
+    if fits:
+        return fits[0]
+    return min(done, key=lambda q: results[q]["size_kb"]) if done else None
+
+def compress_speculative(input_pdf, output_pdf, target_kb, ctl, levels, engine="gs",
+                         digest=None):
+    cancel = threading.Event()
+    outputs = {}
+    for quality in levels:
+        outputs[quality] = admission.work_file(suffix=".pdf")
+
+    results = {}
+    failed = {}
+    winner = None
+    try:
+        with ThreadPoolExecutor(len(levels)) as pool:
+            futures = {pool.submit(run_attempt, input_pdf, outputs[q], q, ctl, cancel,
+                                   engine, digest): q
+                       for q in levels}
+            pending = set(futures)
+            try:
+                while pending and winner is None and not ctl.stopped():
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        quality = futures[future]
+                        try:
+                            results[quality] = future.result()
+                        except ghostscript.Cancelled:
+                            continue
+                        except subprocess.CalledProcessError as e:
+                            # One level failing does not sink the others
+                            failed[quality] = e
+                            ctl.emit("failed", quality=quality)
+                            continue
+                        ctl.produced()
+                    if done:
+                        winner = settled(results, target_kb, levels, failed)
+            finally:
+                # Answer is settled or the caller stopped us: kill the rest
+                cancel.set()
+
+        if winner is None:
+            winner = best_so_far(results, target_kb, levels)
+            if winner is None:
+                if failed and not ctl.stopped():
+                    raise failed[next(q for q in levels if q in failed)]
+                raise ghostscript.Cancelled()
+        ctl.attempts.extend(results[q] for q in levels if q in results)
+        shutil.move(outputs[winner], output_pdf)
+        fits = results[winner]["size_kb"] <= target_kb
+        status = "success" if fits else "stopped" if ctl.stopped() else "best_effort"
+        return outcome(status, results[winner], ctl)
+    finally:
+        for path in outputs.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+def compress_to_target(input_pdf, output_pdf, target_kb, speculative=None, mode=None,
+                       engine=None, digest=None, attempts=None, progress=None, stop=None,
+                       deadline_s=None, analysis=None):
+    """
+    Walk QUALITY_LEVELS until the output fits under target_kb.
+
+    Returns a dict with "status" ("already_under", "success",
+    "best_effort" or "stopped"), the final "size_kb" and "quality",
+    "target_met", and "attempts": one {"quality", "size_kb", "seconds"}
+    entry per gs run.
+
+    With speculative (default: PDF_SPECULATIVE) all levels run in parallel
+    and the result is the same one the sequential ladder would pick.
+    mode="search" (default: PDF_MODE) bisects over image settings instead.
+    engine (default: PDF_ENGINE) picks the ENGINES backend for each attempt.
+    With PDF_ANALYZE on, levels predicted to miss the target are skipped,
+    and long documents start at the level a page sample says will fit.
+    Ladder outputs are cached per input digest (hashed here unless given)
+    and reused across targets; reused attempts carry "reused": True.
+
+    Pass an attempts list to watch attempts as they finish, and progress to
+    get a {"event": "start"|"finish", "t", "quality", ...} dict for each,
+    plus {"event": "analysis", "t", "seconds"} once the input is analyzed
+    (skipped when the caller passes its pdf_analyze report as analysis)
+    and {"event": "failed", "t", "quality"} for a speculative level whose gs
+    run failed (the others still count).
+    Setting the stop event returns the best output so far with status
+    "stopped"; if nothing has finished yet ghostscript.Cancelled is raised.
+    deadline_s (default: PDF_DEADLINE_S) stops the call the same way once
+    it runs out, but never before one output exists.
+    """
+    if speculative is None:
+        speculative = SPECULATIVE
+    if mode is None:
+        mode = MODE
+    if engine is None:
+        engine = ENGINE
+    if digest is None and result_cache.cache is not None:
+        digest = result_cache.file_digest(input_pdf)
+
+    if deadline_s is None:
+        deadline_s = DEADLINE_S
+
+    original_size = get_size_kb(input_pdf)
+    ctl = Control(target_kb, attempts, progress, stop, deadline_s)
+
+    # Always create a temp output first, under the admission work root so
+    # gs outputs count toward its disk limit
+    temp_output = admission.work_file(suffix=".pdf")
+
+    try:
+        # Case 1: already under target
+        if original_size <= target_kb:
+            shutil.copy(input_pdf, temp_output)
+            shutil.move(temp_output, output_pdf)
+            return {"status": "already_under", "size_kb": original_size, "quality": None,
+                    "target_met": True, "attempts": ctl.attempts}
+
+        if mode == "search":
+            return compress_search(input_pdf, output_pdf, target_kb, ctl)
+
+        report = timed_analysis(ctl, analyze_input, input_pdf, analysis)
+        levels = plan_levels(report, target_kb)
+
+        if speculative and len(levels) > 1:
+            return compress_speculative(input_pdf, output_pdf, target_kb, ctl, levels,
+                                        engine, digest)
+
+        above = None
+        # Samples are gs passes, so they say nothing about the images engine
+        # and would cost the full re-render it exists to avoid
+        if report is not None and report["pages"] >= SAMPLE_MIN_PAGES and len(levels) > 1 \
+                and engine != "images":
+            estimates = estimate_by_sampling(input_pdf, report["pages"], levels, target_kb,
+                                             ctl, engine, digest)
+            fits = [q for q in estimates if estimates[q] <= target_kb]
+            # Start where the estimate says it fits; if the real pass still
+            # overshoots, the remaining levels run as the plain ladder.
+            start = levels.index(fits[0]) if fits else len(levels) - 1
+            above = levels[start - 1] if start else None
+            levels = levels[start:]
+
+        # Try compression levels
+        result = compress_ladder(input_pdf, output_pdf, target_kb, ctl, levels, temp_output,
+                                 engine, digest)
+        if above and result["quality"] == levels[0] and \
+                result["size_kb"] < target_kb * SAMPLE_RETRY_BELOW:
+            # The estimate was too pessimistic: the skipped level may fit
+            result = try_level_above(input_pdf, output_pdf, target_kb, ctl, above,
+                                     temp_output, engine, digest) or result
+        return result
+
+    finally:
+        ctl.close()
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+
+def pipeable(size_bytes, engine=None):
+    """Whether compress_bytes() can stand in for compress_to_target()."""
+    # Piping spawns gs for every attempt; pool workers are already running
+    return (size_bytes <= PIPE_MAX_MB * 1024 * 1024 and (engine or ENGINE) == "gs"
+            and MODE == "ladder" and not SPECULATIVE and gs_pool.POOL_SIZE <= 0)
+
+def compress_bytes(data, target_kb, digest=None, attempts=None, progress=None, stop=None,
+                   deadline_s=None, analysis=None):
+    """
+    In-memory compress_to_target() for the plain gs ladder: every attempt
+    pipes data through gs and keeps the output in memory. Returns
+    (output_bytes, result) with result as in compress_to_target().
+    """
+    if deadline_s is None:
+        deadline_s = DEADLINE_S
+    ctl = Control(target_kb, attempts, progress, stop, deadline_s)
+    try:
+        if len(data) // 1024 <= target_kb:
+            return data, {"status": "already_under", "size_kb": len(data) // 1024,
+                          "quality": None, "target_met": True, "attempts": ctl.attempts}
+
+        levels = plan_levels(timed_analysis(ctl, analyze_data, data, analysis), target_kb)
+        status, attempt, out = walk_ladder(levels, target_kb, ctl,
+                                           lambda q: run_attempt_bytes(data, q, ctl, digest))
+        return out, outcome(status, attempt, ctl)
+    finally:
+        ctl.close()
 
 def main():
     if len(sys.argv) != 4:
@@ -49,39 +718,32 @@ def main():
         print("❌ Input file is not a PDF")
         sys.exit(1)
 
-    original_size = get_size_kb(input_pdf)
+    timing = Timing(request_id(os.environ.get("PDF_REQUEST_ID")))
+    events = []
 
-    # Always create a temp output first
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-        temp_output = tmp.name
+    def progress(event):
+        events.append(event)
+        if event["event"] == "finish":
+            reused = ", reused" if event.get("reused") else ""
+            print(f"Tried {event['quality']}: {event['size_kb']} KB ({event['seconds']}s{reused})",
+                  flush=True)
 
-    try:
-        # Case 1: already under target
-        if original_size <= target_kb:
-            shutil.copy(input_pdf, temp_output)
-            shutil.move(temp_output, output_pdf)
-            print(f"ℹ File already under target size ({original_size} KB)")
-            sys.exit(0)
-
-        # Try compression levels
-        for quality in QUALITY_LEVELS:
-            compress_pdf(input_pdf, temp_output, quality)
-            size_kb = get_size_kb(temp_output)
-            print(f"Tried {quality}: {size_kb} KB")
+    result = compress_to_target(input_pdf, output_pdf, target_kb, progress=progress)
+    timing.add_events(events)
+    timing.add_attempts(result["attempts"])
+    timing.log("compress_safe", status=result["status"], size_kb=result["size_kb"],
+               target_kb=target_kb)
 
-            if size_kb <= target_kb:
-                shutil.move(temp_output, output_pdf)
-                print(f"✅ Success: Final size {size_kb} KB")
-                sys.exit(0)
+    if result["status"] == "already_under":
+        print(f"ℹ File already under target size ({result['size_kb']} KB)")
+        sys.exit(0)
 
-        # Best-effort fallback
-        shutil.move(temp_output, output_pdf)
-        print("⚠ Could not reach target size. Best compression applied.")
-        sys.exit(2)
+    if result["status"] == "success":
+        print(f"✅ Success: Final size {result['size_kb']} KB")
+        sys.exit(0)
 
-    finally:
-        if os.path.exists(temp_output):
-            os.remove(temp_output)
+    print("⚠ Could not reach target size. Best compression applied.")
+    sys.exit(2)
 
 if __name__ == "__main__":
     main()
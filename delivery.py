@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# In-memory bodies go out in slices of this size, as views into the buffer
+CHUNK_BYTES = 256 * 1024
+
+def etag_of(data):
+    """Strong ETag from the content, so it is the same in every worker."""
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+def file_etag(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return '"' + h.hexdigest()[:32] + '"'
+
+def not_modified(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag in tags
+
+def parse_range(header, size):
+    """
+    Return (start, end) for a single "bytes=" range, None to send the whole
+    body (no range, several ranges or one we do not understand), or
+    (size, size) when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+        else:
+            start, end = max(size - int(last), 0), size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        return size, size
+    return start, end
+
+def attachment(filename):
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+def send_file(request, path, etag, filename, media_type, headers=None):
+    """
+    A file on disk with ETag/If-None-Match. FileResponse handles Range and
+    If-Range, and hands the path to the server for sendfile when it
+    supports the pathsend extension.
+    """
+    headers = dict(headers or {}, etag=etag)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, filename=filename, headers=headers)
+
+def send_bytes(request, data, etag, filename, media_type, headers=None):
+    """An in-memory body with ETag/If-None-Match and single Range support."""
+    headers = dict(headers or {}, **attachment(filename), etag=etag)
+    headers["Accept-Ranges"] = "bytes"
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = len(data)
+    span = parse_range(request.headers.get("range"), size)
+    if_range = request.headers.get("if-range")
+    if span is not None and if_range is not None and if_range != etag:
+        span = None
+    if span == (size, size):
+        return Response(status_code=416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+
+    start, end = span or (0, size)
+    headers["Content-Length"] = str(end - start)
+    if span is not None:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    view = memoryview(data)
+
+    def body():
+        for offset in range(start, end, CHUNK_BYTES):
+            yield view[offset:min(offset + CHUNK_BYTES, end)]
+
+    return StreamingResponse(body(), status_code=206 if span else 200,
+                             media_type=media_type, headers=headers)
+
+class StaticPage:
+    """
+    A response body built once, with gzip (and brotli, if installed)
+    variants and their ETags computed up front.
+    """
+
+    def __init__(self, body, media_type, cache_control="no-cache"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.media_type = media_type
+        self.cache_control = cache_control
+        etag = etag_of(body)
+        self.variants = {None: (body, etag)}
+        # Compressed variants get their own ETag, as they are different bytes
+        self.variants["gzip"] = (gzip.compress(body, 9, mtime=0), etag[:-1] + '-gz"')
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body), etag[:-1] + '-br"')
+
+    def encoding_for(self, accept_encoding):
+        accepted = set()
+        for item in (accept_encoding or "").split(","):
+            name, _, params = item.partition(";")
+            params = params.replace(" ", "")
+            try:
+                if params.startswith("q=") and float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                pass
+            accepted.add(name.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return None
+
+def send_static(request, page):
+    encoding = page.encoding_for(request.headers.get("accept-encoding"))
+    body, etag = page.variants[encoding]
+    headers = {"ETag": etag, "Cache-Control": page.cache_control, "Vary": "Accept-Encoding"}
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=page.media_type, headers=headers)
@@ -0,0 +1,94 @@
+import os
+import signal
+import subprocess
+import threading
+
+# gs runs as a child process, one per run, so runs are concurrent and can be
+# killed; gs_pool keeps long-lived ones to skip the start-up cost.
+GS_BIN = os.environ.get("PDF_GS_BIN", "gs")
+
+class Cancelled(Exception):
+    """Raised when a gs run is stopped through its cancel event."""
+
+def pdfwrite_args(inputs, output_pdf, quality, extra=()):
+    return [
+        "-sDEVICE=pdfwrite",
+        "-dCompatibilityLevel=1.4",
+        f"-dPDFSETTINGS=/{quality}",
+        "-dNOPAUSE",
+        "-dQUIET",
+        "-dBATCH",
+        *extra,
+        f"-sOutputFile={output_pdf}",
+        *inputs
+    ]
+
+def run(args, cancel=None):
+    """
+    Run Ghostscript with the given arguments (without the leading "gs").
+    Raises subprocess.CalledProcessError on failure.
+
+    cancel is an optional threading.Event; setting it kills the run and
+    raises Cancelled.
+    """
+    if cancel is None:
+        subprocess.run([GS_BIN] + args, check=True)
+        return
+
+    # Own session so a cancel can kill gs together with anything it spawned
+    proc = subprocess.Popen([GS_BIN] + args, start_new_session=True)
+    while proc.poll() is None:
+        if cancel.wait(0.05):
+            kill_tree(proc)
+            raise Cancelled()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, [GS_BIN] + args)
+
+def run_pipe(args, data, cancel=None):
+    """
+    Run the gs binary with data on stdin and return what it writes to
+    stdout. args should read "-" and write -sOutputFile=%stdout; messages
+    are sent to stderr so they cannot end up in the output.
+    """
+    cmd = [GS_BIN, "-sstdout=%stderr"] + args
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, start_new_session=True)
+    # communicate() cannot be resumed after a timeout once it has started
+    # writing stdin, so feed and drain the pipes from threads and poll here
+    output = {}
+
+    def feed():
+        try:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    def drain(name, stream):
+        output[name] = stream.read()
+
+    threads = [threading.Thread(target=feed, daemon=True),
+               threading.Thread(target=drain, args=("out", proc.stdout), daemon=True),
+               threading.Thread(target=drain, args=("err", proc.stderr), daemon=True)]
+    for t in threads:
+        t.start()
+    if cancel is None:
+        proc.wait()
+    while proc.poll() is None:
+        if cancel.wait(0.05):
+            kill_tree(proc)
+            for t in threads:
+                t.join()
+            raise Cancelled()
+    for t in threads:
+        t.join()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=output.get("err"))
+    return output["out"]
+
+def kill_tree(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        proc.kill()
+    proc.wait()
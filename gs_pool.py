@@ -0,0 +1,187 @@
+import os
+import queue
+import select
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import ghostscript
+
+# Workers per quality level; 0 disables the pool.
+POOL_SIZE = int(os.environ.get("PDF_GS_POOL_SIZE", "0"))
+# Recycle a worker after this many jobs or once its RSS passes the limit.
+POOL_MAX_JOBS = int(os.environ.get("PDF_GS_POOL_MAX_JOBS", "50"))
+POOL_MAX_RSS_MB = int(os.environ.get("PDF_GS_POOL_MAX_RSS_MB", "512"))
+POOL_JOB_TIMEOUT = float(os.environ.get("PDF_GS_POOL_JOB_TIMEOUT", "300"))
+# Workers run with -dSAFER and may only touch files under this directory.
+POOL_ROOT = os.path.realpath(os.environ.get("PDF_GS_POOL_ROOT", tempfile.gettempdir()))
+
+def ps_string(s):
+    return "(" + s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+class GhostscriptWorker:
+    """
+    A long-lived gs process for one PDFSETTINGS preset. Jobs are written to
+    its stdin as PostScript; each one switches OutputFile, runs the input and
+    prints a marker line on stdout when it is done.
+    """
+
+    def __init__(self, quality):
+        self.quality = quality
+        self.jobs = 0
+        self.proc = subprocess.Popen(
+            [ghostscript.GS_BIN] + ghostscript.pdfwrite_args(["-_"], "/dev/null", quality, [
+                f"--permit-file-read={POOL_ROOT}/",
+                f"--permit-file-write={POOL_ROOT}/",
+                "--permit-file-write=/dev/null",
+            ]),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.buf = b""
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def read_marker(self, job_id, cancel=None):
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + POOL_JOB_TIMEOUT
+        while True:
+            lines = self.buf.split(b"\n")
+            self.buf = lines.pop()
+            for line in lines:
+                if line.strip() == f"%%DONE {job_id}".encode():
+                    return True
+                if line.strip() == f"%%FAIL {job_id}".encode():
+                    return False
+
+            if cancel is not None and cancel.is_set():
+                raise ghostscript.Cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"gs worker timed out after {POOL_JOB_TIMEOUT}s")
+            ready, _, _ = select.select([fd], [], [], min(remaining, 0.1))
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError("gs worker exited")
+            self.buf += chunk
+
+    def compress(self, input_pdf, output_pdf, cancel=None):
+        job_id = uuid.uuid4().hex
+        self.jobs += 1
+        job = (
+            "{ << /OutputFile " + ps_string(output_pdf) + " >> setpagedevice "
+            + ps_string(input_pdf) + " run "
+            + "<< /OutputFile (/dev/null) >> setpagedevice } stopped "
+            + f"{{ (\\n%%FAIL {job_id}\\n) }} {{ (\\n%%DONE {job_id}\\n) }} ifelse "
+            + "print flush clear cleardictstack\n"
+        )
+        self.proc.stdin.write(job.encode("utf-8"))
+        self.proc.stdin.flush()
+        return self.read_marker(job_id, cancel)
+
+    def worn_out(self):
+        if self.jobs >= POOL_MAX_JOBS:
+            return True
+        rss = rss_mb(self.proc.pid)
+        return rss is not None and rss > POOL_MAX_RSS_MB
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+class GhostscriptPool:
+    def __init__(self, qualities, size):
+        self.idle = {q: queue.Queue() for q in qualities}
+        for q in qualities:
+            for _ in range(size):
+                self.idle[q].put(GhostscriptWorker(q))
+
+    def accepts(self, *paths):
+        root = POOL_ROOT.rstrip("/") + "/"
+        return all(os.path.realpath(p).startswith(root) for p in paths)
+
+    def acquire(self, quality, cancel=None):
+        """Wait for an idle worker, giving up if the run is cancelled meanwhile."""
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise ghostscript.Cancelled()
+            try:
+                return self.idle[quality].get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def compress(self, input_pdf, output_pdf, quality, cancel=None):
+        worker = self.acquire(quality, cancel)
+        ok = cancelled = False
+        try:
+            if not worker.alive():
+                worker = GhostscriptWorker(quality)
+            ok = worker.compress(os.path.realpath(input_pdf),
+                                 os.path.realpath(output_pdf), cancel)
+        except (OSError, EOFError, ghostscript.Cancelled):
+            # Crashed, hung, broken pipe or cancelled mid-job: kill it and
+            # let release() restart it
+            worker.proc.kill()
+            cancelled = cancel is not None and cancel.is_set()
+        finally:
+            self.release(worker, healthy=ok)
+        if cancelled:
+            raise ghostscript.Cancelled()
+        if not ok:
+            raise subprocess.CalledProcessError(1, ["gs", input_pdf])
+
+    def release(self, worker, healthy=True):
+        # Spawn the replacement before handing the slot back so the next
+        # job finds a worker that has already started up.
+        if not healthy or not worker.alive() or worker.worn_out():
+            threading.Thread(target=worker.stop, daemon=True).start()
+            worker = GhostscriptWorker(worker.quality)
+        self.idle[worker.quality].put(worker)
+
+    def close(self):
+        for q in self.idle.values():
+            while not q.empty():
+                q.get_nowait().stop()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(qualities):
+    """Return the shared pool, starting it on first use, or None if disabled."""
+    global _pool
+    if POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = GhostscriptPool(qualities, POOL_SIZE)
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
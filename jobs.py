@@ -0,0 +1,371 @@
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+
+# Finished jobs are forgotten after this long
+JOB_TTL_S = int(os.environ.get("PDF_JOB_TTL_S", "3600"))
+# Job status and events are mirrored to <id>.json here, so any worker
+# process can answer /jobs/{id} for a job another one is running; stop
+# requests for such jobs are left as <id>.stop for the owner to pick up.
+JOBS_DIR = os.environ.get("PDF_JOBS_DIR",
+                          os.path.join(tempfile.gettempdir(), "pdf-under-limit-jobs"))
+STOP_POLL_S = 0.5
+# How often job files past JOB_TTL_S are removed
+PRUNE_INTERVAL_S = 60
+# /jobs/ URLs name a ticket, <job id>-<random>, one per submitter of a
+# (possibly shared) job
+TICKET_RE = re.compile(r"([0-9a-f]{32})-[0-9a-f]{12}")
+# Run time assumed for a job before any have finished, and the weight of
+# each new run in the moving average
+DEFAULT_JOB_S = 5.0
+AVG_WEIGHT = 0.2
+
+# Queued jobs run cheapest first; every second spent waiting takes AGING
+# off a job's cost, so a big job is not starved by a stream of small ones.
+AGING = float(os.environ.get("PDF_SJF_AGING", "1.0"))
+# Cost classes for the queue latency stats, by upper bound
+COST_CLASSES = [("small", 1.0), ("medium", 10.0), ("large", float("inf"))]
+LATENCY_SAMPLES = 200
+
+def cost_class(cost):
+    return next(name for name, bound in COST_CLASSES if cost < bound)
+
+class Job:
+    def __init__(self, fn, args, cost=0.0):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.cost = cost
+        self.cls = cost_class(cost)
+        self.state = "queued"
+        self.attempts = []
+        # Progress events in order, for /jobs/{id}/events; setting stop asks
+        # fn to wrap up with what it has
+        self.events = []
+        self.stop = threading.Event()
+        self.cancelled = False
+        # Requests sharing this job (see JobManager.share); job API
+        # submitters also hold a ticket, and stop only takes effect once
+        # every waiter has asked for it
+        self.key = None
+        self.waiters = 1
+        self.tickets = set()
+        self.stops = set()
+        self.lock = threading.Lock()
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = Future()
+        self.path = None
+
+    def emit(self, event):
+        """Progress callback: record the event and publish it."""
+        self.events.append(event)
+        self.publish()
+
+    def publish(self):
+        if self.path is None:
+            return
+        with self.lock:
+            snapshot = dict(self.to_dict(), events=list(self.events), finished=self.finished,
+                            tickets=sorted(self.tickets))
+            tmp = f"{self.path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+    def cancel(self):
+        """
+        Drop one waiter. When none are left, stop the job and mark its
+        output for discarding; returns True in that case.
+        """
+        with self.lock:
+            self.waiters -= 1
+            if self.waiters > 0:
+                if len(self.stops) >= self.waiters:
+                    self.stop.set()
+                return False
+            self.cancelled = True
+            self.stop.set()
+        return True
+
+    def add_ticket(self):
+        ticket = f"{self.id}-{secrets.token_hex(6)}"
+        with self.lock:
+            self.tickets.add(ticket)
+        self.publish()
+        return ticket
+
+    def request_stop(self, ticket):
+        """One ticket holder's stop; the job stops once every waiter has asked."""
+        with self.lock:
+            if ticket not in self.tickets:
+                return
+            self.stops.add(ticket)
+            if len(self.stops) >= self.waiters:
+                self.stop.set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "class": self.cls,
+            "attempts": list(self.attempts),
+            "result": self.result,
+            "error": self.error,
+            "queued_s": round((self.started or time.time()) - self.created, 3),
+            "elapsed_s": round((self.finished or time.time()) - self.started, 3)
+                         if self.started else None,
+        }
+
+class RemoteJob:
+    """Read-only view of a job run by another worker process, from its file."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.id = snapshot["id"]
+        self.state = snapshot["state"]
+        self.events = snapshot["events"]
+        self.result = snapshot["result"]
+        self.finished = snapshot["finished"]
+        self.tickets = set(snapshot.get("tickets", []))
+
+    def to_dict(self):
+        return {k: v for k, v in self.snapshot.items()
+                if k not in ("events", "finished", "tickets")}
+
+class JobManager:
+    """
+    Runs submitted jobs on a fixed number of worker threads, cheapest
+    first with aging (see AGING).
+    fn is called as fn(job, *args) so it can publish progress on the job;
+    its return value becomes job.result and resolves job.future. A job that
+    fails after being stopped ends up "cancelled" instead of "failed"; fn
+    should check job.stop before starting work.
+    """
+
+    def __init__(self, workers, root=JOBS_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.jobs = {}
+        self.inflight = {}
+        self.pending = []
+        self.lock = threading.RLock()
+        self.ready = threading.Condition(self.lock)
+        self.waits = {name: deque(maxlen=LATENCY_SAMPLES) for name, _ in COST_CLASSES}
+        self.workers = workers
+        self.running = 0
+        self.avg_seconds = DEFAULT_JOB_S
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+        threading.Thread(target=self.watch_stops, daemon=True).start()
+        threading.Thread(target=self.prune_files, daemon=True).start()
+
+    def submit(self, fn, *args, cost=0.0):
+        """
+        Queue fn; in memory only, as it runs on the event loop. The job's
+        file is first written by add_ticket() or when a worker starts it.
+        """
+        job = Job(fn, args, cost)
+        job.path = os.path.join(self.root, job.id + ".json")
+        # Reentrant for share()
+        with self.ready:
+            self.prune()
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            self.ready.notify()
+        return job
+
+    def share(self, key, fn, *args, cost=0.0):
+        """
+        Like submit(), but joins the unfinished, unstopped job with the same
+        key if there is one. Returns (job, joined).
+        """
+        with self.ready:
+            job = self.inflight.get(key)
+            if job is not None:
+                with job.lock:
+                    if not job.stop.is_set():
+                        job.waiters += 1
+                        return job, True
+            job = self.submit(fn, *args, cost=cost)
+            job.key = key
+            self.inflight[key] = job
+        return job, False
+
+    def next_job(self):
+        with self.ready:
+            while not self.pending:
+                self.ready.wait()
+            now = time.time()
+            job = min(self.pending, key=lambda j: j.cost - AGING * (now - j.created))
+            self.pending.remove(job)
+            self.running += 1
+            self.waits[job.cls].append(now - job.created)
+        return job
+
+    def get(self, ticket):
+        """
+        The Job behind a ticket if this process runs it, else a RemoteJob,
+        else None.
+        """
+        m = TICKET_RE.fullmatch(ticket)
+        if m is None:
+            return None
+        with self.lock:
+            job = self.jobs.get(m.group(1))
+        if job is None:
+            try:
+                with open(os.path.join(self.root, m.group(1) + ".json")) as f:
+                    job = RemoteJob(json.load(f))
+            except (OSError, ValueError):
+                return None
+        return job if ticket in job.tickets else None
+
+    def stop(self, ticket):
+        """A ticket holder's stop request, wherever the job runs."""
+        job = self.get(ticket)
+        if isinstance(job, Job):
+            job.request_stop(ticket)
+        elif job is not None and job.finished is None:
+            open(os.path.join(self.root, ticket + ".stop"), "w").close()
+
+    def watch_stops(self):
+        """Pass on stop requests that other worker processes left for our jobs."""
+        while True:
+            time.sleep(STOP_POLL_S)
+            with self.lock:
+                live = [j for j in self.jobs.values() if j.finished is None]
+            for job in live:
+                with job.lock:
+                    tickets = list(job.tickets)
+                for ticket in tickets:
+                    flag = os.path.join(self.root, ticket + ".stop")
+                    if os.path.exists(flag):
+                        job.request_stop(ticket)
+                        os.remove(flag)
+
+    def load(self):
+        """Return (queued, running) job counts."""
+        with self.lock:
+            return len(self.pending), self.running
+
+    def queue_stats(self):
+        """Per cost class: jobs waiting now and recent queue latency."""
+        with self.lock:
+            stats = {}
+            for name, _ in COST_CLASSES:
+                waits = sorted(self.waits[name])
+                stats[name] = {
+                    "queued": sum(1 for j in self.pending if j.cls == name),
+                    "samples": len(waits),
+                    "avg_wait_s": round(sum(waits) / len(waits), 3) if waits else None,
+                    "p95_wait_s": round(waits[int(len(waits) * 0.95)], 3) if waits else None,
+                }
+        return stats
+
+    def prune(self):
+        cutoff = time.time() - JOB_TTL_S
+        for job_id in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def prune_files(self):
+        """Remove files of any process's jobs, including ones that died, after JOB_TTL_S."""
+        while True:
+            time.sleep(PRUNE_INTERVAL_S)
+            cutoff = time.time() - JOB_TTL_S
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            job.state = "running"
+            job.started = time.time()
+            job.publish()
+            error = None
+            try:
+                job.result = job.fn(job, *job.args)
+            except Exception as e:
+                error = e
+            # Finished jobs are kept until JOB_TTL_S for status requests;
+            # don't keep their inputs (possibly a whole upload) alive too
+            job.fn, job.args = None, ()
+
+            finished = time.time()
+            with self.lock:
+                self.running -= 1
+                self.avg_seconds += AVG_WEIGHT * (finished - job.started - self.avg_seconds)
+                # A stopped or finished job takes no new waiters
+                if job.key is not None and self.inflight.get(job.key) is job:
+                    del self.inflight[job.key]
+
+            # State before finished: /jobs/{id}/events reads them in that order
+            if error is None:
+                job.state = "done"
+            else:
+                job.error = str(error) or type(error).__name__
+                job.state = "cancelled" if job.stop.is_set() else "failed"
+            job.finished = finished
+            job.publish()
+            # add_ticket() may still be adding to the set from the event loop
+            with job.lock:
+                tickets = list(job.tickets)
+            for ticket in tickets:
+                try:
+                    os.remove(os.path.join(self.root, ticket + ".stop"))
+                except OSError:
+                    pass
+            if error is None:
+                job.future.set_result(job.result)
+            else:
+                job.future.set_exception(error)
+
+class SingleFlight:
+    """
+    Runs fn once per key at a time: callers that arrive while it is running
+    wait for it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        """Return (result, shared), shared being True for callers that waited."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result(), True
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
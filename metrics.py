@@ -0,0 +1,201 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+# Every worker process writes its own counters to <pid>-<id>.json here and
+# /metrics adds up all of them, so the numbers cover the whole server no
+# matter which worker answers the scrape. Files of workers that have exited
+# are folded into archive.json so counters never go backwards.
+METRICS_DIR = os.environ.get("PDF_METRICS_DIR",
+                             os.path.join(tempfile.gettempdir(), "pdf-under-limit-metrics"))
+FLUSH_INTERVAL_S = 1.0
+ARCHIVE = "archive.json"
+
+SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATIO = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+ITERATIONS = (1, 2, 3, 4, 6, 8, 10, 12, 15)
+
+HISTOGRAMS = {
+    "pdf_upload_seconds": ("Time to receive and hash a PDF upload", SECONDS),
+    "pdf_queue_wait_seconds": ("Time a job waited before a worker picked it up", SECONDS),
+    "pdf_gs_seconds": ("Ghostscript run time per quality level", SECONDS),
+    "pdf_gs_output_ratio": ("Ghostscript output size over input size per quality level", RATIO),
+    "image_encode_iterations": ("JPEG encodes per compress-image request", ITERATIONS),
+}
+COUNTERS = {
+    "cache_requests_total": "Compression requests by kind and cache result",
+    "target_results_total": "Finished compressions by kind and whether the target was met",
+}
+GAUGES = {
+    "work_disk_bytes": "Bytes held in work dirs",
+    "results_disk_bytes": "Bytes held in stored results on disk",
+}
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+class Registry:
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # The flush loop and every scrape flush; one at a time, so they
+        # neither share a temp file nor write an older snapshot last
+        self.flush_lock = threading.Lock()
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count over the last bucket, sum]
+        self.histograms = {}
+        # Set by start(), in the worker process itself (after any fork)
+        self.path = None
+        self.dirty = False
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.dirty = True
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, labels_key(labels))
+        with self.lock:
+            counts = self.histograms.setdefault(key, [0] * (len(buckets) + 2))
+            counts[next((i for i, b in enumerate(buckets) if value <= b), len(buckets))] += 1
+            counts[-1] += value
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            self.dirty = False
+            return dump(self.counters, self.histograms)
+
+    def flush(self):
+        if self.path is None:
+            return
+        with self.flush_lock:
+            if self.dirty:
+                write_json(self.path, self.snapshot())
+
+    def start(self, interval=FLUSH_INTERVAL_S):
+        os.makedirs(self.root, exist_ok=True)
+        archive_dead(self.root)
+        self.path = os.path.join(self.root, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except OSError:
+                    # Disk full or the like; keep counting and retry next time
+                    pass
+        threading.Thread(target=loop, daemon=True).start()
+
+    def collect(self):
+        """Counters and histograms summed over every worker's file."""
+        self.flush()
+        total = {"counters": {}, "histograms": {}}
+        if not os.path.isdir(self.root):
+            return total
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            # Shared, so an archive_dead() cannot move a file mid-read
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for name in os.listdir(self.root):
+                if name.endswith(".json"):
+                    merge(total, read_json(os.path.join(self.root, name)))
+        return total
+
+    def render(self, gauges=None):
+        """The Prometheus text exposition format."""
+        total = self.collect()
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (n, labels), counts in sorted(total["histograms"].items()):
+                if n != name:
+                    continue
+                running = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], counts[:-1]):
+                    running += count
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append(f"{name}_bucket{fmt_labels(labels + (('le', le),))} {running}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {running}")
+        for name, help_text in COUNTERS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (n, labels), value in sorted(total["counters"].items()):
+                if n == name:
+                    lines.append(f"{name}{fmt_labels(labels)} {value}")
+        for name, value in (gauges or {}).items():
+            lines += [f"# HELP {name} {GAUGES[name]}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+def fmt_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+def dump(counters, histograms):
+    return {"counters": [[n, dict(l), v] for (n, l), v in counters.items()],
+            "histograms": [[n, dict(l), list(c)] for (n, l), c in histograms.items()]}
+
+def merge(total, snapshot):
+    for name, labels, value in snapshot.get("counters", []):
+        key = (name, labels_key(labels))
+        total["counters"][key] = total["counters"].get(key, 0) + value
+    for name, labels, counts in snapshot.get("histograms", []):
+        key = (name, labels_key(labels))
+        if name not in HISTOGRAMS or len(counts) != len(HISTOGRAMS[name][1]) + 2:
+            # Written with other buckets by an older version
+            continue
+        old = total["histograms"].get(key)
+        total["histograms"][key] = counts if old is None else [a + b for a, b in zip(old, counts)]
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def archive_dead(root):
+    """Fold the files of exited workers into the archive, under a lock."""
+    with open(os.path.join(root, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = []
+        for name in os.listdir(root):
+            pid = name.split("-", 1)[0]
+            if name.endswith(".json") and pid.isdigit() and not pid_alive(int(pid)):
+                dead.append(os.path.join(root, name))
+        if not dead:
+            return
+        total = {"counters": {}, "histograms": {}}
+        for path in [os.path.join(root, ARCHIVE)] + dead:
+            merge(total, read_json(path))
+        write_json(os.path.join(root, ARCHIVE), dump(total["counters"], total["histograms"]))
+        for path in dead:
+            os.remove(path)
+
+registry = Registry(METRICS_DIR)
+inc = registry.inc
+observe = registry.observe
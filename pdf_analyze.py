@@ -0,0 +1,292 @@
+import re
+import sys
+import zlib
+from collections import Counter
+
+OBJ_RE = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+WS = b" \t\r\n\f\x00"
+
+# Target image resolution of each PDFSETTINGS preset and the factor above it
+# at which pdfwrite starts downsampling.
+QUALITY_DPI = {"printer": 300, "ebook": 150, "screen": 72}
+DOWNSAMPLE_THRESHOLD = 1.5
+# Rough size ratios observed for pdfwrite output. OTHER_BYTES_RATIO (fonts,
+# content streams, everything but images) is a guess, not a measurement, so
+# callers should not lean on predictions for files that are mostly text.
+FLATE_TO_JPEG_RATIO = 0.35
+OTHER_BYTES_RATIO = 0.8
+
+def skip_string(data, i):
+    depth = 0
+    while i < len(data):
+        c = data[i]
+        if c == 0x5C:  # backslash
+            i += 2
+            continue
+        if c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+def dict_end(data, i):
+    """Return the offset just past the << ... >> dict starting at i."""
+    depth = 0
+    n = len(data)
+    while i < n:
+        if data.startswith(b"<<", i):
+            depth += 1
+            i += 2
+        elif data.startswith(b">>", i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        elif data[i] == 0x28:
+            i = skip_string(data, i)
+        elif data[i] == 0x3C:
+            i = data.find(b">", i) + 1 or n
+        elif data[i] == 0x25:  # comment
+            while i < n and data[i] not in b"\r\n":
+                i += 1
+        else:
+            i += 1
+    return n
+
+def get_value(d, key):
+    m = re.search(rb"/" + key + rb"(?![A-Za-z0-9])\s*(\[[^\]]*\]|/[^\s/\[\]<>()]+|\d+\s+\d+\s+R|[-+\d.]+)", d)
+    return m.group(1) if m else None
+
+def get_int(d, key):
+    v = get_value(d, key)
+    if v is None or v.endswith(b"R"):
+        return None
+    try:
+        return int(float(v))
+    except ValueError:
+        return None
+
+def get_names(d, key):
+    v = get_value(d, key)
+    if v is None:
+        return []
+    return [n.decode("latin-1") for n in re.findall(rb"/([^\s/\[\]<>()]+)", v)]
+
+def get_ref(d, key):
+    v = get_value(d, key)
+    if v is None or not v.endswith(b"R"):
+        return None
+    return int(v.split()[0])
+
+def get_numbers(d, key):
+    v = get_value(d, key)
+    if v is None or not v.startswith(b"["):
+        return None
+    try:
+        return [float(x) for x in v[1:-1].split()]
+    except ValueError:
+        return None
+
+def iter_objects(data):
+    """
+    Linear scan for "N G obj ... endobj" without relying on the xref, which
+    is often broken in scanner output. Yields dicts with the object number,
+    its byte range, the dict bytes and the stream data range (or None).
+    """
+    pos = 0
+    while True:
+        m = OBJ_RE.search(data, pos)
+        if not m:
+            return
+        num, gen = int(m.group(1)), int(m.group(2))
+        i = m.end()
+        while i < len(data) and data[i] in WS:
+            i += 1
+
+        d = b""
+        stream = None
+        if data.startswith(b"<<", i):
+            end = dict_end(data, i)
+            d = data[i:end]
+            j = end
+            while j < len(data) and data[j] in WS:
+                j += 1
+            if data.startswith(b"stream", j):
+                start = j + 6
+                if data.startswith(b"\r\n", start):
+                    start += 2
+                elif data[start:start + 1] in (b"\n", b"\r"):
+                    start += 1
+                length = get_int(d, b"Length")
+                stop = start + length if length is not None else -1
+                after = data[stop:stop + 20].lstrip(WS) if length is not None else b""
+                if not after.startswith(b"endstream"):
+                    stop = data.find(b"endstream", start)
+                    if stop < 0:
+                        return
+                    while stop > start and data[stop - 1] in b"\r\n":
+                        stop -= 1
+                stream = (start, stop)
+                i = stop
+            else:
+                i = end
+
+        close = data.find(b"endobj", i)
+        if close < 0:
+            close = len(data)
+        yield {"num": num, "gen": gen, "start": m.start(), "end": close + 6,
+               "dict": d, "stream": stream,
+               "body": data[m.end():close] if stream is None else None}
+        pos = close + 6
+
+def decode_flate(raw, d):
+    filters = get_names(d, b"Filter")
+    if filters != ["FlateDecode"] or get_value(d, b"DecodeParms") is not None:
+        return None
+    try:
+        return zlib.decompress(raw)
+    except zlib.error:
+        return None
+
+def iter_object_stream(data, obj):
+    """Yield (num, bytes) for objects packed in an /ObjStm."""
+    d = obj["dict"]
+    raw = decode_flate(data[obj["stream"][0]:obj["stream"][1]], d)
+    n, first = get_int(d, b"N"), get_int(d, b"First")
+    if raw is None or n is None or first is None:
+        return
+    header = raw[:first].split()
+    pairs = [(int(header[k]), int(header[k + 1])) for k in range(0, min(len(header), 2 * n) - 1, 2)]
+    for k, (num, off) in enumerate(pairs):
+        end = pairs[k + 1][1] if k + 1 < len(pairs) else len(raw) - first
+        yield num, raw[first + off:first + end]
+
+def load_objects(data):
+    """Map object number -> object, latest revision wins."""
+    objects = {}
+    for obj in iter_objects(data):
+        objects[obj["num"]] = obj
+        if obj["stream"] and b"/ObjStm" in obj["dict"]:
+            for index, (num, body) in enumerate(iter_object_stream(data, obj)):
+                if num not in objects:
+                    body = body.strip()
+                    objects[num] = {"num": num, "gen": 0, "start": None, "end": None,
+                                    "dict": body if body.startswith(b"<<") else b"",
+                                    "stream": None, "body": body,
+                                    "packed": obj["num"], "index": index}
+    return objects
+
+def is_type(d, name):
+    return re.search(rb"/Type\s*/" + name + rb"(?![A-Za-z0-9])", d) is not None
+
+def has_key(d, key):
+    return re.search(rb"/" + key + rb"(?![A-Za-z0-9])", d) is not None
+
+def trailer_dicts(data, objects):
+    """Every classic trailer dict and XRef stream dict, in file order."""
+    dicts = [(m.start(), data[m.end():dict_end(data, m.end())])
+             for m in re.finditer(rb"trailer\s*(?=<<)", data)]
+    dicts += [(o["start"], o["dict"]) for o in objects.values()
+              if o["start"] is not None and is_type(o["dict"], b"XRef")]
+    return [d for _, d in sorted(dicts, key=lambda x: x[0])]
+
+def analyze(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(b"%PDF-"):
+        raise ValueError("not a PDF")
+    return analyze_bytes(data)
+
+def analyze_bytes(data, objects=None):
+    if objects is None:
+        objects = load_objects(data)
+
+    pages = [o for o in objects.values() if is_type(o["dict"], b"Page")]
+    roots = [o for o in objects.values()
+             if is_type(o["dict"], b"Pages") and get_value(o["dict"], b"Parent") is None]
+    page_count = get_int(roots[0]["dict"], b"Count") if roots else None
+    if page_count is None:
+        page_count = len(pages)
+
+    page_size = (8.27, 11.69)  # A4 unless the file says otherwise
+    for o in pages + roots:
+        box = get_numbers(o["dict"], b"MediaBox")
+        if box and len(box) == 4 and box[2] > box[0] and box[3] > box[1]:
+            page_size = ((box[2] - box[0]) / 72, (box[3] - box[1]) / 72)
+            break
+
+    font_files = set()
+    for o in objects.values():
+        for key in (b"FontFile", b"FontFile2", b"FontFile3"):
+            ref = get_ref(o["dict"], key)
+            if ref is not None:
+                font_files.add(ref)
+
+    images = []
+    filters = Counter()
+    font_bytes = 0
+    for o in objects.values():
+        if not o["stream"]:
+            continue
+        d = o["dict"]
+        size = o["stream"][1] - o["stream"][0]
+        names = get_names(d, b"Filter")
+        filters.update(names or ["None"])
+        if o["num"] in font_files:
+            font_bytes += size
+        if re.search(rb"/Subtype\s*/Image\b", d):
+            width, height = get_int(d, b"Width") or 0, get_int(d, b"Height") or 0
+            # Assumes the image spans the page, which holds for scans
+            dpi = round(max(width / page_size[0], height / page_size[1]))
+            images.append({"num": o["num"], "width": width, "height": height,
+                           "bpc": get_int(d, b"BitsPerComponent"),
+                           "colorspace": (get_names(d, b"ColorSpace") or [None])[0],
+                           "filters": names, "bytes": size, "dpi": dpi})
+
+    image_bytes = sum(i["bytes"] for i in images)
+    return {
+        "size_bytes": len(data),
+        "pages": page_count,
+        "page_size_in": (round(page_size[0], 2), round(page_size[1], 2)),
+        "encrypted": any(has_key(d, b"Encrypt") for d in trailer_dicts(data, objects)),
+        "image_count": len(images),
+        "image_bytes": image_bytes,
+        "image_share": round(image_bytes / len(data), 3) if data else 0,
+        "images": images,
+        "font_bytes": font_bytes,
+        "filters": dict(filters),
+    }
+
+def predict_size_kb(report, quality):
+    """Estimate pdfwrite output size for a PDFSETTINGS preset."""
+    target_dpi = QUALITY_DPI[quality]
+    image_bytes = 0
+    for img in report["images"]:
+        size = img["bytes"]
+        if img["bpc"] != 1 and img["dpi"] > target_dpi * DOWNSAMPLE_THRESHOLD:
+            size *= (target_dpi / img["dpi"]) ** 2
+            if "DCTDecode" not in img["filters"]:
+                size *= FLATE_TO_JPEG_RATIO
+        image_bytes += size
+    other = (report["size_bytes"] - report["image_bytes"]) * OTHER_BYTES_RATIO
+    return int((image_bytes + other) // 1024)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 pdf_analyze.py input.pdf")
+        sys.exit(1)
+
+    report = analyze(sys.argv[1])
+    print(f"Pages: {report['pages']} ({report['page_size_in'][0]} x {report['page_size_in'][1]} in)")
+    print(f"Images: {report['image_count']}, {report['image_bytes'] // 1024} KB "
+          f"({report['image_share'] * 100:.0f}% of file)")
+    for img in report["images"]:
+        print(f"  obj {img['num']}: {img['width']}x{img['height']} ~{img['dpi']} dpi "
+              f"{'/'.join(img['filters']) or 'raw'} {img['bytes'] // 1024} KB")
+    print(f"Fonts: {report['font_bytes'] // 1024} KB")
+    print(f"Filters: {report['filters']}")
+    for quality in QUALITY_DPI:
+        print(f"Predicted {quality}: {predict_size_kb(report, quality)} KB")
@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import ghostscript
+import pdf_analyze
+
+# Target resolution and JPEG quality per PDFSETTINGS preset; images are only
+# downsampled above DOWNSAMPLE_THRESHOLD times the target, like pdfwrite.
+IMAGE_SETTINGS = {"printer": (300, 85), "ebook": (150, 75), "screen": (72, 50)}
+MIN_PIXELS = 64 * 64
+# Keep the original stream unless the new one saves at least this much
+MIN_SAVING = 0.9
+WORKERS = os.cpu_count() or 1
+
+MODES = {b"/DeviceRGB": "RGB", b"/DeviceGray": "L"}
+
+def candidate(obj):
+    """Return the Pillow mode for an image we can safely rewrite, else None."""
+    d = obj["dict"]
+    if not obj["stream"] or not re.search(rb"/Subtype\s*/Image\b", d):
+        return None
+    if pdf_analyze.get_int(d, b"BitsPerComponent") != 8:
+        return None
+    for key in (b"DecodeParms", b"Decode", b"Mask", b"ImageMask"):
+        if pdf_analyze.get_value(d, key) is not None:
+            return None
+    if pdf_analyze.get_names(d, b"Filter") not in (["DCTDecode"], ["FlateDecode"]):
+        return None
+    width = pdf_analyze.get_int(d, b"Width") or 0
+    height = pdf_analyze.get_int(d, b"Height") or 0
+    if width * height < MIN_PIXELS:
+        return None
+    return MODES.get(pdf_analyze.get_value(d, b"ColorSpace"))
+
+def recompress(raw, d, mode, dpi, quality):
+    """Return (jpeg_bytes, width, height), or None to keep the original."""
+    target_dpi, jpeg_quality = IMAGE_SETTINGS[quality]
+    width, height = pdf_analyze.get_int(d, b"Width"), pdf_analyze.get_int(d, b"Height")
+    try:
+        if pdf_analyze.get_names(d, b"Filter") == ["DCTDecode"]:
+            img = Image.open(io.BytesIO(raw))
+            if img.mode != mode:
+                return None
+        else:
+            img = Image.frombytes(mode, (width, height), zlib.decompress(raw))
+    except (OSError, ValueError, zlib.error):
+        return None
+
+    if dpi > target_dpi * pdf_analyze.DOWNSAMPLE_THRESHOLD:
+        scale = target_dpi / dpi
+        img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                         Image.BICUBIC)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=jpeg_quality)
+    if buf.tell() > len(raw) * MIN_SAVING:
+        return None
+    return buf.getvalue(), img.width, img.height
+
+def drop_key(d, key):
+    return re.sub(rb"/" + key + rb"(?![A-Za-z0-9])\s*(\[[^\]]*\]|/[^\s/\[\]<>()]+|\d+\s+\d+\s+R|[-+\d.]+)",
+                  b"", d, count=1)
+
+def image_object(obj, d, stream, width, height):
+    for key in (b"Width", b"Height", b"Filter", b"Length"):
+        d = drop_key(d, key)
+    head = f"<< /Width {width} /Height {height} /Filter /DCTDecode /Length {len(stream)} ".encode()
+    return (f"{obj['num']} {obj['gen']} obj\n".encode() + head + d[2:]
+            + b"\nstream\n" + stream + b"\nendstream\nendobj\n")
+
+def trailer_values(data, objects):
+    """
+    Collect /Root, /Info and /ID from every trailer; later ones win. Raises
+    ValueError for encrypted files, whose strings and streams we cannot
+    carry over without their /Encrypt dict.
+    """
+    dicts = pdf_analyze.trailer_dicts(data, objects)
+    if any(pdf_analyze.has_key(d, b"Encrypt") for d in dicts):
+        raise ValueError("encrypted")
+    values = {}
+    for d in dicts:
+        for key in (b"Root", b"Info", b"ID"):
+            v = pdf_analyze.get_value(d, key)
+            if v is not None:
+                values[key] = v
+    return values
+
+def write_pdf(data, objects, replaced):
+    """
+    Rewrite the file with a fresh xref. Old xref streams and the
+    linearization dict are dropped; objects packed in object streams stay
+    where they are and get type 2 entries in a new xref stream.
+    """
+    trailer = trailer_values(data, objects)
+    if b"Root" not in trailer:
+        raise ValueError("no /Root in trailer")
+
+    out = io.BytesIO()
+    header = re.match(rb"%PDF-\d\.\d", data)
+    out.write((header.group(0) if header else b"%PDF-1.4") + b"\n%\xe2\xe3\xcf\xd3\n")
+
+    offsets = {}
+    top = sorted((o for o in objects.values() if o["start"] is not None), key=lambda o: o["start"])
+    for o in top:
+        if pdf_analyze.is_type(o["dict"], b"XRef") or \
+                pdf_analyze.get_value(o["dict"], b"Linearized") is not None:
+            continue
+        offsets[o["num"]] = (out.tell(), o["gen"])
+        out.write(replaced.get(o["num"]) or data[o["start"]:o["end"]] + b"\n")
+
+    packed = {o["num"]: (o["packed"], o["index"]) for o in objects.values()
+              if o.get("packed") in offsets}
+    extra = b"".join(b" /" + k + b" " + v for k, v in trailer.items())
+    xref_at = out.tell()
+
+    if not packed:
+        size = max(offsets) + 1
+        out.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+        for num in range(1, size):
+            off, gen = offsets.get(num, (0, 65535))
+            out.write(f"{off:010d} {gen:05d} {'n' if num in offsets else 'f'} \n".encode())
+        out.write(f"trailer\n<< /Size {size}".encode() + extra + b" >>\n")
+    else:
+        num_xref = max(list(offsets) + list(packed)) + 1
+        size = num_xref + 1
+        offsets[num_xref] = (xref_at, 0)
+        rows = []
+        for num in range(size):
+            if num in offsets:
+                rows.append(bytes([1]) + offsets[num][0].to_bytes(4, "big") + offsets[num][1].to_bytes(2, "big"))
+            elif num in packed:
+                rows.append(bytes([2]) + packed[num][0].to_bytes(4, "big") + packed[num][1].to_bytes(2, "big"))
+            else:
+                rows.append(bytes([0, 0, 0, 0, 0, 0xFF, 0xFF]))
+        stream = zlib.compress(b"".join(rows))
+        out.write(f"{num_xref} 0 obj\n<< /Type /XRef /Size {size} /W [1 4 2] "
+                  f"/Filter /FlateDecode /Length {len(stream)}".encode() + extra
+                  + b" >>\nstream\n" + stream + b"\nendstream\nendobj\n")
+
+    out.write(f"startxref\n{xref_at}\n%%EOF\n".encode())
+    return out.getvalue()
+
+def compress_pdf_images(input_pdf, output_pdf, quality, cancel=None):
+    """
+    Recompress and downsample the JPEG/Flate image XObjects with Pillow and
+    write them back in place, leaving page content, fonts and structure
+    alone. Files this cannot handle safely go through gs instead.
+    """
+    with open(input_pdf, "rb") as f:
+        data = f.read()
+
+    try:
+        objects = pdf_analyze.load_objects(data)
+        report = pdf_analyze.analyze_bytes(data, objects)
+    except ValueError:
+        # e.g. a malformed object stream
+        report = None
+    if report is None or report["encrypted"]:
+        ghostscript.run(ghostscript.pdfwrite_args([input_pdf], output_pdf, quality), cancel)
+        return
+
+    dpi = {img["num"]: img["dpi"] for img in report["images"]}
+    jobs = [(o, mode) for o in objects.values()
+            if o["start"] is not None and (mode := candidate(o))]
+
+    def work(job):
+        if cancel is not None and cancel.is_set():
+            raise ghostscript.Cancelled()
+        o, mode = job
+        return recompress(data[o["stream"][0]:o["stream"][1]], o["dict"], mode,
+                          dpi.get(o["num"], 0), quality)
+
+    replaced = {}
+    with ThreadPoolExecutor(WORKERS) as pool:
+        for (o, _), result in zip(jobs, pool.map(work, jobs)):
+            if result is not None:
+                replaced[o["num"]] = image_object(o, o["dict"], *result)
+
+    try:
+        out = write_pdf(data, objects, replaced)
+    except ValueError:
+        ghostscript.run(ghostscript.pdfwrite_args([input_pdf], output_pdf, quality), cancel)
+        return
+    with open(output_pdf, "wb") as f:
+        f.write(out)
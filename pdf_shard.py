@@ -0,0 +1,74 @@
+import os
+import shutil
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import admission
+import ghostscript
+import pdf_analyze
+
+# Each shard gets at least SHARD_MIN_PAGES pages; at most PDF_SHARDS shards
+# (default: one per core).
+SHARD_MIN_PAGES = int(os.environ.get("PDF_SHARD_MIN_PAGES", "20"))
+MAX_SHARDS = int(os.environ.get("PDF_SHARDS", "0")) or os.cpu_count() or 1
+
+def shard_ranges(page_count, shards):
+    size, extra = divmod(page_count, shards)
+    ranges, first = [], 1
+    for k in range(shards):
+        last = first + size - 1 + (1 if k < extra else 0)
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+def compress_pdf_sharded(input_pdf, output_pdf, quality, cancel=None, page_count=None):
+    """
+    Compress page ranges in parallel gs processes, then merge the shards.
+
+    Shards embed whole fonts (-dSubsetFonts=false) so the merge pass sees
+    identical font programs, writes each one once and subsets it there.
+    Images are already at the preset resolution by then, so the merge
+    does not downsample or re-encode them again.
+    """
+    if page_count is None:
+        try:
+            page_count = pdf_analyze.analyze(input_pdf)["pages"]
+        except (OSError, ValueError):
+            page_count = 0
+    shards = min(MAX_SHARDS, page_count // SHARD_MIN_PAGES)
+    if shards < 2:
+        ghostscript.run(ghostscript.pdfwrite_args([input_pdf], output_pdf, quality), cancel)
+        return
+
+    work = admission.work_dir()
+    # A failed shard stops its siblings, and so does the caller's cancel;
+    # a private event keeps a shard failure from looking like a cancel.
+    stop = threading.Event()
+    try:
+        paths = [os.path.join(work, f"shard{k}.pdf") for k in range(shards)]
+
+        def run_shard(k, first, last):
+            ghostscript.run(ghostscript.pdfwrite_args(
+                [input_pdf], paths[k], quality,
+                [f"-dFirstPage={first}", f"-dLastPage={last}", "-dSubsetFonts=false"],
+            ), stop)
+
+        with ThreadPoolExecutor(shards) as pool:
+            futures = [pool.submit(run_shard, k, first, last)
+                       for k, (first, last) in enumerate(shard_ranges(page_count, shards))]
+            try:
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    if cancel is not None and cancel.is_set():
+                        raise ghostscript.Cancelled()
+            except BaseException:
+                stop.set()
+                raise
+
+        ghostscript.run(ghostscript.pdfwrite_args(
+            paths, output_pdf, quality, ["-dSubsetFonts=true"]), cancel)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.environ.get("PDF_CACHE_DIR",
+                           os.path.join(tempfile.gettempdir(), "pdf-under-limit-cache"))
+CACHE_MAX_MB = int(os.environ.get("PDF_CACHE_MAX_MB", "512"))
+CACHE_TTL_S = int(os.environ.get("PDF_CACHE_TTL_S", str(24 * 3600)))
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Disk cache of compression results keyed on the input hash, the target
+    and the mode. Each entry is <key>.bin plus a <key>.json sidecar; the
+    .bin mtime is bumped on every hit and drives LRU eviction and the TTL.
+    """
+
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(digest, kind, target_kb, mode):
+        return hashlib.sha256(f"{kind}:{digest}:{target_kb}:{mode}".encode()).hexdigest()
+
+    def paths(self, key):
+        base = os.path.join(self.root, key)
+        return base + ".bin", base + ".json"
+
+    def get(self, key, count=True):
+        """
+        Return (path, meta) for a live entry and count the hit or miss.
+        Internal lookups such as ladder variants pass count=False so the
+        stats only cover whole requests.
+        """
+        data_path, meta_path = self.paths(key)
+        try:
+            if time.time() - os.path.getmtime(data_path) > self.ttl:
+                raise FileNotFoundError(data_path)
+            with open(meta_path) as f:
+                meta = json.load(f)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            if count:
+                with self.lock:
+                    self.misses += 1
+            return None
+        if count:
+            with self.lock:
+                self.hits += 1
+        return data_path, meta
+
+    def get_bytes(self, key, count=True):
+        entry = self.get(key, count)
+        if entry is None:
+            return None
+        try:
+            with open(entry[0], "rb") as f:
+                return f.read(), entry[1]
+        except OSError:
+            return None
+
+    def put(self, key, src=None, data=None, meta=None):
+        """Store a copy of the file at src, or the given bytes, atomically."""
+        data_path, meta_path = self.paths(key)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if src is not None:
+                    with open(src, "rb") as s:
+                        shutil.copyfileobj(s, f)
+                else:
+                    f.write(data)
+            meta_tmp = tmp[:-4] + ".json.tmp"
+            with open(meta_tmp, "w") as f:
+                json.dump(meta or {}, f)
+            os.replace(meta_tmp, meta_path)
+            os.replace(tmp, data_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".tmp"):
+                # Left behind by a writer that died mid-put
+                if now - st.st_mtime > self.ttl:
+                    self.remove(path)
+                continue
+            if not name.endswith(".bin"):
+                continue
+            if now - st.st_mtime > self.ttl:
+                self.remove(path)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, data_path):
+        paths = [data_path]
+        if data_path.endswith(".bin"):
+            paths.append(data_path[:-4] + ".json")
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses,
+                "hit_rate": round(hits / total, 3) if total else 0.0}
+
+cache = ResultCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024, CACHE_TTL_S) if CACHE_MAX_MB > 0 else None
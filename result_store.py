@@ -0,0 +1,131 @@
+import json
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+
+from delivery import etag_of, file_etag
+
+# Finished outputs wait here for download under an opaque token, for up to
+# RESULTS_TTL_S and within RESULTS_MAX_MB (oldest go first).
+RESULTS_DIR = os.environ.get("PDF_RESULTS_DIR",
+                             os.path.join(tempfile.gettempdir(), "pdf-under-limit-results"))
+RESULTS_MAX_MB = int(os.environ.get("PDF_RESULTS_MAX_MB", "1024"))
+RESULTS_TTL_S = int(os.environ.get("PDF_RESULTS_TTL_S", "3600"))
+SWEEP_INTERVAL_S = 60
+# Work dirs and files older than this belong to no live job
+ORPHAN_AGE_S = int(os.environ.get("PDF_WORK_ORPHAN_S", str(6 * 3600)))
+
+class ResultStore:
+    """
+    Results on disk as <token>.bin plus a <token>.json sidecar, where every
+    worker process can serve them. Downloads do not remove anything;
+    sweep() expires entries and enforces the quota.
+    """
+
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+
+    def paths(self, token):
+        base = os.path.join(self.root, token)
+        return base + ".bin", base + ".json"
+
+    def put_file(self, src, filename, media_type="application/pdf"):
+        """Move src into the store and return its token."""
+        token = secrets.token_urlsafe(16)
+        data_path, meta_path = self.paths(token)
+        with open(meta_path, "w") as f:
+            json.dump({"filename": filename, "media_type": media_type,
+                       "etag": file_etag(src)}, f)
+        shutil.move(src, data_path)
+        self.sweep()
+        return token
+
+    def put_bytes(self, data, filename, media_type="application/pdf"):
+        """Write data into the store and return its token."""
+        token = secrets.token_urlsafe(16)
+        data_path, meta_path = self.paths(token)
+        with open(meta_path, "w") as f:
+            json.dump({"filename": filename, "media_type": media_type,
+                       "etag": etag_of(data)}, f)
+        with open(data_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(data_path + ".tmp", data_path)
+        self.sweep()
+        return token
+
+    def get(self, token):
+        """Return (path, meta) for a live entry, else None."""
+        if not token.replace("-", "").replace("_", "").isalnum():
+            return None
+        data_path, meta_path = self.paths(token)
+        try:
+            if time.time() - os.path.getmtime(data_path) > self.ttl:
+                return None
+            with open(meta_path) as f:
+                return data_path, json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def remove(self, token):
+        data_path, meta_path = self.paths(token)
+        # .tmp: a put_bytes() that died mid-write
+        for path in (data_path, meta_path, data_path + ".tmp"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            token = name.split(".", 1)[0]
+            if now - st.st_mtime > self.ttl:
+                self.remove(token)
+            elif name.endswith(".bin"):
+                entries.append((st.st_mtime, st.st_size, token))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, token in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(token)
+            total -= size
+
+def sweep_orphans(root, age=ORPHAN_AGE_S):
+    """Remove work dirs and files under root left behind by crashed jobs."""
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - age
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+def start_sweeper(store, work_root, interval=SWEEP_INTERVAL_S):
+    def loop():
+        while True:
+            time.sleep(interval)
+            store.sweep()
+            sweep_orphans(work_root)
+    threading.Thread(target=loop, daemon=True).start()
+
+store = ResultStore(RESULTS_DIR, RESULTS_MAX_MB * 1024 * 1024, RESULTS_TTL_S)
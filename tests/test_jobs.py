@@ -0,0 +1,15 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jobs import JobManager
+
+
+def test_finished_job_drops_its_inputs(tmp_path):
+    jobs = JobManager(1, root=str(tmp_path))
+    data = b"x" * (1 << 20)
+    job = jobs.submit(lambda job, payload: len(payload), data)
+    assert job.future.result(timeout=5) == len(data)
+    assert job.state == "done"
+    assert job.fn is None and job.args == ()
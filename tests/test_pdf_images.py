@@ -0,0 +1,150 @@
+import io
+import re
+import sys
+import zlib
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pdf_analyze
+import pdf_images
+
+
+def build_pdf(bodies, trailer):
+    """A PDF with the given "N 0 obj" bodies, a correct xref and trailer."""
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = {}
+    for num, body in bodies.items():
+        offsets[num] = out.tell()
+        out.write(f"{num} 0 obj\n".encode() + body + b"\nendobj\n")
+    size = max(offsets) + 1
+    xref_at = out.tell()
+    out.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+    for num in range(1, size):
+        out.write(f"{offsets.get(num, 0):010d} 00000 {'n' if num in offsets else 'f'} \n".encode())
+    out.write(b"trailer\n" + trailer + f"\nstartxref\n{xref_at}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def stream_obj(d, data):
+    return d + f" /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream"
+
+
+def sample_pdf(trailer=b"<< /Size 6 /Root 1 0 R /Info 5 0 R >>"):
+    pixels = zlib.compress(bytes(range(256)) * 3 * 64)
+    content = b"q 612 0 0 792 0 0 cm /Im0 Do Q"
+    return build_pdf({
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        3: b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+           b"/Resources << /XObject << /Im0 4 0 R >> >> /Contents 6 0 R >>",
+        4: stream_obj(b"<< /Type /XObject /Subtype /Image /Width 256 /Height 64 "
+                      b"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode", pixels),
+        5: b"<< /Producer (test) >>",
+        6: stream_obj(b"<<", content),
+    }, trailer)
+
+
+def check_xref(out):
+    """Every in-use xref entry must point at the object it names."""
+    xref_at = int(re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", out).group(1))
+    assert out.startswith(b"xref", xref_at)
+    lines = out[xref_at:].split(b"\n")
+    first, count = map(int, lines[1].split())
+    for k in range(count):
+        off, gen, kind = lines[2 + k].split()
+        if kind == b"n":
+            assert out.startswith(f"{first + k} {int(gen)} obj".encode(), int(off))
+    return xref_at
+
+
+def test_round_trip_keeps_objects_and_trailer():
+    data = sample_pdf()
+    objects = pdf_analyze.load_objects(data)
+    out = pdf_images.write_pdf(data, objects, {})
+
+    xref_at = check_xref(out)
+    trailer = out[out.index(b"trailer", xref_at):]
+    assert pdf_analyze.get_value(trailer, b"Root") == b"1 0 R"
+    assert pdf_analyze.get_value(trailer, b"Info") == b"5 0 R"
+    again = pdf_analyze.load_objects(out)
+    assert sorted(again) == sorted(objects)
+    for num, o in objects.items():
+        assert again[num]["dict"] == o["dict"]
+        if o["stream"]:
+            assert out[slice(*again[num]["stream"])] == data[slice(*o["stream"])]
+
+
+def test_replaced_image_is_readable():
+    data = sample_pdf()
+    objects = pdf_analyze.load_objects(data)
+    buf = io.BytesIO()
+    Image.new("RGB", (128, 32), (200, 10, 10)).save(buf, "JPEG")
+    replaced = {4: pdf_images.image_object(objects[4], objects[4]["dict"], buf.getvalue(), 128, 32)}
+    out = pdf_images.write_pdf(data, objects, replaced)
+
+    check_xref(out)
+    img = pdf_analyze.load_objects(out)[4]
+    assert pdf_analyze.get_names(img["dict"], b"Filter") == ["DCTDecode"]
+    assert pdf_analyze.get_int(img["dict"], b"Width") == 128
+    assert pdf_analyze.get_int(img["dict"], b"Length") == len(buf.getvalue())
+    assert Image.open(io.BytesIO(out[slice(*img["stream"])])).size == (128, 32)
+
+
+def test_object_streams_get_an_xref_stream():
+    packed = b"<< /Type /Catalog /Pages 2 0 R >>"
+    header = b"1 0 "
+    objstm = zlib.compress(header + packed)
+    data = build_pdf({
+        2: b"<< /Type /Pages /Kids [] /Count 0 >>",
+        7: stream_obj(f"<< /Type /ObjStm /N 1 /First {len(header)} /Filter /FlateDecode".encode(),
+                      objstm),
+    }, b"<< /Size 8 /Root 1 0 R >>")
+    objects = pdf_analyze.load_objects(data)
+    out = pdf_images.write_pdf(data, objects, {})
+
+    xref_at = int(re.search(rb"startxref\s+(\d+)", out).group(1))
+    xref = next(o for o in pdf_analyze.load_objects(out).values()
+                if o["start"] == xref_at)
+    rows = zlib.decompress(out[slice(*xref["stream"])])
+    entries = [rows[k:k + 7] for k in range(0, len(rows), 7)]
+    assert entries[1][0] == 2 and int.from_bytes(entries[1][1:5], "big") == 7
+    for num in (2, 7):
+        off = int.from_bytes(entries[num][1:5], "big")
+        assert entries[num][0] == 1 and out.startswith(f"{num} 0 obj".encode(), off)
+    assert pdf_analyze.get_value(xref["dict"], b"Root") == b"1 0 R"
+
+
+def test_encrypt_after_id_is_detected_and_not_rewritten():
+    trailer = (b"<< /Size 6 /Root 1 0 R /ID [<0123456789abcdef><0123456789abcdef>] "
+               b"/Encrypt 5 0 R >>")
+    data = sample_pdf(trailer)
+    objects = pdf_analyze.load_objects(data)
+    assert pdf_analyze.analyze_bytes(data, objects)["encrypted"]
+    with pytest.raises(ValueError):
+        pdf_images.write_pdf(data, objects, {})
+
+
+def test_plain_file_is_not_encrypted():
+    data = sample_pdf(b"<< /Size 6 /Root 1 0 R /ID [<00ff><00ff>] >>")
+    assert not pdf_analyze.analyze_bytes(data)["encrypted"]
+
+
+def test_unparseable_file_goes_through_gs(tmp_path, monkeypatch):
+    objstm = zlib.compress(b"1 x << /Type /Catalog >>")
+    data = build_pdf({
+        7: stream_obj(b"<< /Type /ObjStm /N 1 /First 4 /Filter /FlateDecode", objstm),
+    }, b"<< /Size 8 /Root 1 0 R >>")
+    with pytest.raises(ValueError):
+        pdf_analyze.load_objects(data)
+
+    src = tmp_path / "in.pdf"
+    src.write_bytes(data)
+    runs = []
+    monkeypatch.setattr(pdf_images.ghostscript, "run", lambda args, cancel=None: runs.append(args))
+    pdf_images.compress_pdf_images(str(src), str(tmp_path / "out.pdf"), "ebook")
+    assert len(runs) == 1 and str(src) in runs[0]
@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from upload import UploadError, receive_upload
+
+MAX_BYTES = 1024 * 1024
+
+
+async def endpoint(request):
+    try:
+        upload = await receive_upload(request, None, MAX_BYTES, magic=b"%PDF")
+    except UploadError as e:
+        return PlainTextResponse(str(e), status_code=e.status_code)
+    return PlainTextResponse(f"{upload.size} {upload.fields.get('target_kb')}")
+
+
+client = TestClient(Starlette(routes=[Route("/", endpoint, methods=["POST"])]))
+
+
+def post_file(data):
+    return client.post("/", files={"file": ("a.pdf", data, "application/pdf")},
+                       data={"target_kb": "100"})
+
+
+def test_valid_upload():
+    r = post_file(b"%PDF-1.4 hello")
+    assert r.status_code == 200 and r.text == "14 100"
+
+
+def test_malformed_body_is_a_400():
+    r = client.post("/", content=b"garbage",
+                    headers={"content-type": "multipart/form-data; boundary=xyz"})
+    assert r.status_code == 400 and r.text == "Malformed form data"
+
+
+def test_oversize_upload_is_a_413():
+    r = post_file(b"%PDF" + b"x" * MAX_BYTES)
+    assert r.status_code == 413
+
+
+def test_wrong_magic_is_a_400():
+    r = post_file(b"GIF89a not a pdf")
+    assert r.status_code == 400 and r.text == "Not a PDF file"
@@ -0,0 +1,75 @@
+import json
+import logging
+import re
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+# One JSON line per compression request on stderr, under the same request
+# id the response carries in X-Request-ID. The compress_safe CLI takes the
+# id from PDF_REQUEST_ID, so a caller running it can log under its own id.
+log = logging.getLogger("pdf_under_limit")
+if not log.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+def request_id(incoming=None):
+    """Keep an id handed to us (e.g. by the load balancer) if it looks sane."""
+    if incoming and re.fullmatch(r"[A-Za-z0-9._-]{1,64}", incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+class Timing:
+    """Named stage durations for one request, in the order they happened."""
+
+    def __init__(self, rid=None):
+        self.id = rid or request_id()
+        self.started = time.monotonic()
+        self.stages = []
+
+    def add(self, name, seconds, desc=None):
+        self.stages.append((name, seconds, desc))
+
+    @contextmanager
+    def stage(self, name, desc=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started, desc)
+
+    def add_attempts(self, attempts):
+        """One gsN stage per gs run (or cache reuse) in a compress_safe attempts list."""
+        for n, attempt in enumerate(attempts, 1):
+            desc = attempt["quality"] + (" (cached)" if attempt.get("reused") else "")
+            self.add(f"gs{n}", attempt["seconds"], desc)
+
+    def add_events(self, events):
+        """Stages reported through a compress_safe progress callback."""
+        for event in events:
+            if event["event"] == "analysis":
+                self.add("analysis", event["seconds"])
+
+    def header(self):
+        """The Server-Timing header value, with a total."""
+        parts = []
+        for name, seconds, desc in self.stages + [("total", time.monotonic() - self.started, None)]:
+            part = name
+            if desc:
+                part += ';desc="' + desc.replace("\\", "").replace('"', "'") + '"'
+            parts.append(f"{part};dur={seconds * 1000:.1f}")
+        return ", ".join(parts)
+
+    def headers(self):
+        return {"Server-Timing": self.header(), "X-Request-ID": self.id}
+
+    def log(self, event, **fields):
+        stages = [{"stage": name, "ms": round(seconds * 1000, 1), **({"desc": desc} if desc else {})}
+                  for name, seconds, desc in self.stages]
+        log.info(json.dumps({"request_id": self.id, "event": event,
+                             "total_ms": round((time.monotonic() - self.started) * 1000, 1),
+                             "stages": stages, **fields}))
@@ -0,0 +1,132 @@
+import hashlib
+import os
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+# Plain form fields are small; anything bigger is not from our form
+MAX_FIELD_BYTES = 64 * 1024
+
+class UploadError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class Upload:
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.filename = None
+        self.size = 0
+        self.digest = None
+        self.fields = {}
+
+async def receive_upload(request, path, max_bytes, magic=None, file_field="file"):
+    """
+    Parse a multipart/form-data body as it arrives. The file_field part is
+    written once, straight to path (or kept in memory as upload.data when
+    path is None), and hashed on the way; the upload is rejected as soon as
+    it passes max_bytes or its first bytes do not match magic. Returns an
+    Upload with the SHA-256 digest and the other fields.
+    """
+    ctype, options = parse_options_header(request.headers.get("content-type", ""))
+    if ctype != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadError(400, "Expected multipart/form-data")
+
+    upload = Upload(path)
+    sha = hashlib.sha256()
+    head = bytearray()
+    # The part being parsed; file data is gathered in chunks and written
+    # after each network read, or kept until the end for in-memory uploads
+    part = {}
+    header = {"field": b"", "value": b"", "disposition": b""}
+    chunks = []
+
+    def on_part_begin():
+        part.clear()
+        header["disposition"] = b""
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        if header["field"].lower() == b"content-disposition":
+            header["disposition"] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished():
+        _, params = parse_options_header(header["disposition"])
+        part["name"] = params.get(b"name", b"").decode("latin-1")
+        part["file"] = part["name"] == file_field
+        part["value"] = bytearray()
+        if part["file"]:
+            upload.filename = params.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if part["file"]:
+            chunk = data[start:end]
+            upload.size += len(chunk)
+            if upload.size > max_bytes:
+                raise UploadError(413, f"Upload larger than {max_bytes // (1024 * 1024)} MB")
+            if magic and len(head) < len(magic):
+                head.extend(chunk[:len(magic) - len(head)])
+                if not magic.startswith(bytes(head)):
+                    raise UploadError(400, "Not a PDF file")
+            sha.update(chunk)
+            chunks.append(chunk)
+        else:
+            part["value"] += data[start:end]
+            if len(part["value"]) > MAX_FIELD_BYTES:
+                raise UploadError(400, "Form field too large")
+
+    def on_part_end():
+        if not part["file"]:
+            upload.fields[part["name"]] = part["value"].decode("utf-8", "replace")
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    def discard():
+        if path is not None:
+            os.remove(path)
+
+    f = await run_in_threadpool(open, path, "wb") if path is not None else None
+    try:
+        try:
+            async for data in request.stream():
+                parser.write(data)
+                if chunks and f is not None:
+                    await run_in_threadpool(f.write, b"".join(chunks))
+                    chunks.clear()
+            parser.finalize()
+        except MultipartParseError:
+            raise UploadError(400, "Malformed form data") from None
+    except BaseException:
+        if f is not None:
+            f.close()
+        discard()
+        raise
+    if f is not None:
+        f.close()
+    else:
+        upload.data = b"".join(chunks)
+
+    if upload.filename is None:
+        discard()
+        raise UploadError(400, f"Missing {file_field}")
+    if magic and bytes(head) != magic:
+        discard()
+        raise UploadError(400, "Not a PDF file")
+    upload.digest = sha.hexdigest()
+    return upload